@@ -1,45 +1,63 @@
-import math
 import numpy as np
 import random
+import shapely
 import sys
 import time
 import pandas as pd
-from collections import defaultdict
 from sklearn.linear_model import LogisticRegression
 from shapely.geometry import LineString, MultiPolygon, Polygon
 from sklearn.neighbors import KernelDensity
 from sklearn.model_selection import GridSearchCV
 from sklearn.model_selection import LeaveOneOut
-from queue import PriorityQueue
-from utilities import CsvReader
+from topk import SpillingTopKPairs
+from utilities import CsvReader, SourceData, TargetData
 from datamodel import RelatedGeometries
+from spatialindex import EquiGrid, createIndex
+import mbr
 
 class Extrapolation:
 
-    def __init__(self, budget: int, qPairs: int, delimiter: str, sourceFilePath: str, targetFilePath: str, users_input):
+    def __init__(self, budget: int, qPairs: int, delimiter: str, sourceFilePath: str, targetFilePath: str, users_input, streamTargets: bool = False, readWorkers: int = 1, sourceIndexPath: str = None, indexType: str = 'equigrid', streamSources: bool = False, topKMemoryLimit: int = SpillingTopKPairs.MEMORY_LIMIT, spillDirectory: str = None):
         self.users_input = users_input
         self.CLASS_SIZE = 50
         self.NO_OF_FEATURES = 16
         self.SAMPLE_SIZE = 100
         self.POSITIVE_PAIR = 1
         self.NEGATIVE_PAIR = 0
+        self.THETA_DRIFT = 0.25
+        self.VERIFICATION_BATCH = 4096
         self.trainingPhase = False
 
         self.budget = budget
         self.delimiter = delimiter
-        self.sourceData = CsvReader.readAllEntities(delimiter, sourceFilePath)
+        # out of core, only the source bounds are held in memory and geometries are decoded on demand
+        self.streamSources = streamSources
+        if streamSources:
+            self.sourceData = SourceData(delimiter, sourceFilePath)
+            self.sourceBounds = self.sourceData.getBounds()
+        else:
+            sourceEntities = CsvReader.loadAllEntities(delimiter, sourceFilePath, workers = readWorkers)
+            self.sourceData = sourceEntities.geometries
+            self.sourceBounds = sourceEntities.bounds
+        self.sourceFilePath = sourceFilePath
+        self.sourceIndexPath = sourceIndexPath
+        self.indexType = indexType
         print('Source geometries', len(self.sourceData))
 
         self.targetFilePath = targetFilePath
+        self.targetData = TargetData(delimiter, targetFilePath, streamTargets, workers = readWorkers)
         self.datasetDelimiter = len(self.sourceData)
         self.relations = RelatedGeometries(qPairs)
         self.sample = []
         self.sample_for_verification = []
-        self.spatialIndex = defaultdict(lambda: defaultdict(list))
+        self.spatialIndex = None
         self.verifiedPairs = set()
         self.minimum_probability_threshold = 0
         self.thetaX = -1
         self.thetaY = -1
+        # the top-K spills to disk beyond this many bytes
+        self.topKMemoryLimit = topKMemoryLimit
+        self.spillDirectory = spillDirectory
 
     def applyProcessing(self) :
       time1 = int(time.time() * 1000)
@@ -59,170 +77,122 @@ class Extrapolation:
       print("Verification Time\t:\t" + str(time5 - time4))
       self.relations.print()
 
-    def indexSource(self) :
-      geometryId = 0
-      for sEntity in self.sourceData:
-        self.addToIndex(geometryId, sEntity.bounds)
-        geometryId += 1
-
-    def addToIndex(self, geometryId, envelope) :
-        maxX = math.ceil(envelope[2] / self.thetaX)
-        maxY = math.ceil(envelope[3] / self.thetaY)
-        minX = math.floor(envelope[0] / self.thetaX)
-        minY = math.floor(envelope[1] / self.thetaY)
+    # links as the run finds them, while it goes on; see RelatedGeometries.iterLinks
+    def iterLinks(self, bufferSize = 64):
+        return self.relations.iterLinks(self.applyProcessing, bufferSize)
 
-        for latIndex in range(minX, maxX+1):
-          for longIndex in range(minY, maxY+1):
-              self.spatialIndex[latIndex][longIndex].append(geometryId)
+    # with a sourceIndexPath, the equigrid and the per-source statistics computed in an earlier run
+    # over the same source file are reused
+    def indexSource(self) :
+      if self.sourceIndexPath is not None and self.indexType in ('equigrid', 'refpoint'):
+        metadata = {'source': CsvReader.getCacheKey(self.delimiter, self.sourceFilePath), 'upperInclusive': True, 'indexType': self.indexType}
+        storedIndex = EquiGrid.open(self.sourceIndexPath, metadata)
+        if storedIndex is not None:
+          self.spatialIndex, sourceStatistics = storedIndex
+          self.sourceAreas = sourceStatistics['sourceAreas']
+          self.sourceLengths = sourceStatistics['sourceLengths']
+          self.sourcePoints = sourceStatistics['sourcePoints']
+          return
+
+      self.spatialIndex = createIndex(self.indexType, self.thetaX, self.thetaY, upperInclusive = True).build(self.sourceBounds)
+      self.sourceAreas = mbr.getAreas(self.sourceBounds)
+      sourceLengths, sourcePoints = [np.empty(0)], [np.empty(0, dtype=np.int64)]
+      for firstId, sourceChunk in (self.sourceData.chunks() if self.streamSources else [(0, self.sourceData)]):
+        sourceLengths.append(shapely.length(sourceChunk))
+        sourcePoints.append(np.array([self.getNoOfPoints(s) for s in sourceChunk], dtype=np.int64))
+      self.sourceLengths, self.sourcePoints = np.concatenate(sourceLengths), np.concatenate(sourcePoints)
+      if self.sourceIndexPath is not None and self.indexType in ('equigrid', 'refpoint'):
+        try:
+          self.spatialIndex.save(self.sourceIndexPath, metadata, {'sourceAreas': self.sourceAreas, 'sourceLengths': self.sourceLengths, 'sourcePoints': self.sourcePoints})
+        except OSError as e:
+          print("Could not write source index", self.sourceIndexPath, e)
 
     def preprocessing(self):
-        self.flag = [-1] * len(self.sourceData)
-        self.frequency = [-1] * len(self.sourceData)
-        self.distinctCooccurrences =  [0] * len(self.sourceData)
-        self.realCandidates =  [0] * len(self.sourceData)
-        self.totalCooccurrences =  [0] * len(self.sourceData)
+        self.frequency = np.zeros(len(self.sourceData), dtype=np.int64)
+        self.distinctCooccurrences = np.zeros(len(self.sourceData), dtype=np.int64)
+        self.realCandidates = np.zeros(len(self.sourceData), dtype=np.int64)
+        self.totalCooccurrences = np.zeros(len(self.sourceData), dtype=np.int64)
+        self.targetCooccurrences = np.zeros(len(self.targetData), dtype=np.int64)
+        self.targetDistinctCooccurrences = np.zeros(len(self.targetData), dtype=np.int64)
+        self.targetCandidates = np.zeros(len(self.targetData), dtype=np.int64)
         self.maxFeatures = [-sys.float_info.max] * self.NO_OF_FEATURES
         self.minFeatures = [sys.float_info.max] * self.NO_OF_FEATURES
         self.totalCandidatePairs = 0
-        for s in self.sourceData:
-            if self.maxFeatures[0] < s.envelope.area:
-                self.maxFeatures[0] = s.envelope.area
-
-            if s.envelope.area < self.minFeatures[0]:
-                self.minFeatures[0] = s.envelope.area
-
-            no_of_blocks = self.getNoOfBlocks(s.bounds)
-            if self.maxFeatures[3] < no_of_blocks:
-                self.maxFeatures[3] = no_of_blocks
-
-            if no_of_blocks < self.minFeatures[3]:
-                self.minFeatures[3] = no_of_blocks
 
-            no_of_points = self.getNoOfPoints(s)
-            if self.maxFeatures[6] < no_of_points:
-                self.maxFeatures[6] = no_of_points
-
-            if no_of_points < self.minFeatures[6]:
-                self.minFeatures[6] = no_of_points
-
-            if self.maxFeatures[8] < s.length:
-                self.maxFeatures[8] = s.length
-
-            if s.length < self.minFeatures[8]:
-                self.minFeatures[8] = s.length
-
-        targetData = CsvReader.readAllEntities("\t", self.targetFilePath)
-
-        max_candidate_pairs = self.datasetDelimiter * len(targetData)
+        max_candidate_pairs = self.datasetDelimiter * len(self.targetData)
         selected_pairs = set(random.sample(range(0, max_candidate_pairs), self.SAMPLE_SIZE))
 
-        targetGeomId, pairId = 0, 0
-        for targetGeom in targetData:
-            if self.maxFeatures[1] < targetGeom.envelope.area:
-                self.maxFeatures[1] = targetGeom.envelope.area
-
-            if targetGeom.envelope.area < self.minFeatures[1]:
-                self.minFeatures[1] = targetGeom.envelope.area
-
-            noOfBlocks = self.getNoOfBlocks(targetGeom.bounds)
-            if self.maxFeatures[4] < noOfBlocks:
-                self.maxFeatures[4] = noOfBlocks
-
-            if noOfBlocks < self.minFeatures[4]:
-                self.minFeatures[4] = noOfBlocks
-
-            no_of_points = self.getNoOfPoints(s)
-            if self.maxFeatures[7] < no_of_points:
-                self.maxFeatures[7] = no_of_points
-
-            if no_of_points < self.minFeatures[7]:
-                self.minFeatures[7] = no_of_points
-
-            if self.maxFeatures[9] < targetGeom.length:
-                self.maxFeatures[9] = targetGeom.length
-
-            if targetGeom.length < self.minFeatures[9]:
-                self.minFeatures[9] = targetGeom.length
-
-            candidateMatches = self.getCandidates(targetGeomId, targetGeom)
-
-            currentCandidates = 0
-            currentDistinctCooccurrences = len(candidateMatches)
-            currentCooccurrences = 0
-
-            for candidateMatchId in candidateMatches:
-              self.totalCandidatePairs += 1
-              self.distinctCooccurrences[candidateMatchId] += 1
-              currentCooccurrences += self.frequency[candidateMatchId]
-
-              self.totalCooccurrences[candidateMatchId] += self.frequency[candidateMatchId]
-
-              if self.validCandidate(candidateMatchId, targetGeom.envelope):
-                  currentCandidates += 1
-                  self.realCandidates[candidateMatchId] += 1
-
-                  mbrIntersection = self.sourceData[candidateMatchId].envelope.intersection(targetGeom.envelope)
-
-                  if self.maxFeatures[2] < mbrIntersection.area:
-                      self.maxFeatures[2] = mbrIntersection.area
-
-                  if mbrIntersection.area < self.minFeatures[2]:
-                      self.minFeatures[2] = mbrIntersection.area
-
-                  if self.maxFeatures[5] < self.frequency[candidateMatchId]:
-                      self.maxFeatures[5] =  self.frequency[candidateMatchId]
-
-                  if self.frequency[candidateMatchId] < self.minFeatures[5]:
-                      self.minFeatures[5] = self.frequency[candidateMatchId]
-                  if len(self.sample) < 1000:
-                        self.random_number = random.randint(0, 1)
-                        if self.random_number == 0:
-                          self.sample.append((candidateMatchId, targetGeomId, targetGeom))
-                  #Create sample for verification
-                  if len(self.sample_for_verification) < 500:
-                        if self.random_number == 1:
-                          self.sample_for_verification.append((candidateMatchId, targetGeomId, targetGeom))
-
-                  pairId += 1
-
-            if self.maxFeatures[13] < currentCooccurrences:
-                self.maxFeatures[13] = currentCooccurrences
-
-            if currentCooccurrences < self.minFeatures[13]:
-                self.minFeatures[13] = currentCooccurrences
-
-            if self.maxFeatures[14] < currentDistinctCooccurrences:
-                self.maxFeatures[14] = currentDistinctCooccurrences
-
-            if currentDistinctCooccurrences < self.minFeatures[14]:
-                self.minFeatures[14] = currentDistinctCooccurrences
-
-            if self.maxFeatures[15] < currentCandidates:
-                self.maxFeatures[15] = currentCandidates
-
-            if currentCandidates < self.minFeatures[15]:
-                self.minFeatures[15] = currentCandidates
-
-            targetGeomId += 1
-
-        for i in range(self.datasetDelimiter):
-            if self.maxFeatures[10] < self.totalCooccurrences[i]:
-                self.maxFeatures[10] = self.totalCooccurrences[i]
-
-            if self.totalCooccurrences[i] < self.minFeatures[10]:
-                self.minFeatures[10] = self.totalCooccurrences[i]
-
-            if self.maxFeatures[11] < self.distinctCooccurrences[i]:
-                self.maxFeatures[11] = self.distinctCooccurrences[i]
-
-            if self.distinctCooccurrences[i] < self.minFeatures[11]:
-                self.minFeatures[11] = self.distinctCooccurrences[i]
-
-            if self.maxFeatures[12] < self.realCandidates[i]:
-                self.maxFeatures[12] = self.realCandidates[i]
-
-            if self.realCandidates[i] < self.minFeatures[12]:
-                self.minFeatures[12] = self.realCandidates[i]
+        for firstId, targetChunk, targetBounds in self.targetData.chunks():
+            self.relations.checkCancelled()
+            self.updateFeatureRange(1, mbr.getAreas(targetBounds))
+            self.updateFeatureRange(4, self.spatialIndex.getNoOfBlocks(targetBounds))
+            self.updateFeatureRange(9, shapely.length(targetChunk))
+
+            sourceIds, targetIds, commonBlocks = self.spatialIndex.getCandidatePairs(targetBounds, firstId)
+            localIds = targetIds - firstId
+            valid = self.addPairStatistics(sourceIds, localIds, commonBlocks, targetBounds, firstId)
+            # every distinct candidate pair counts, whether or not the MBRs intersect
+            self.totalCandidatePairs += len(sourceIds)
+            self.samplePairs(sourceIds[valid], localIds[valid], firstId, targetChunk)
+
+        self.setFeatureRanges()
+
+    # Adds (sign 1) or takes away (sign -1) the co-occurrences of candidate pairs with the targets
+    # of a block starting at firstId; localIds and the rows of targetBounds are relative to firstId.
+    # Returns which of the pairs are valid candidates.
+    def addPairStatistics(self, sourceIds, localIds, commonBlocks, targetBounds, firstId, sign = 1):
+        valid = mbr.intersects(self.sourceBounds[sourceIds], targetBounds[localIds])
+        self.distinctCooccurrences += sign * np.bincount(sourceIds, minlength=len(self.sourceData))
+        self.totalCooccurrences += sign * np.bincount(sourceIds, weights=commonBlocks, minlength=len(self.sourceData)).astype(np.int64)
+        self.realCandidates += sign * np.bincount(sourceIds[valid], minlength=len(self.sourceData))
+
+        targets = slice(firstId, firstId + len(targetBounds))
+        self.targetCooccurrences[targets] += sign * np.bincount(localIds, weights=commonBlocks, minlength=len(targetBounds)).astype(np.int64)
+        self.targetDistinctCooccurrences[targets] += sign * np.bincount(localIds, minlength=len(targetBounds))
+        self.targetCandidates[targets] += sign * np.bincount(localIds[valid], minlength=len(targetBounds))
+
+        # the ranges of the pair features only ever widen, taking pairs away leaves them as they are
+        if 0 < sign:
+            self.updateFeatureRange(2, mbr.getIntersectionAreas(self.sourceBounds[sourceIds[valid]], targetBounds[localIds[valid]]))
+            self.updateFeatureRange(5, commonBlocks[valid])
+        return valid
+
+    # ranges of the features that depend on the source geometries, deleted sources left out
+    def setFeatureRanges(self):
+        live = ~np.isnan(self.sourceBounds).any(axis=1)
+        features = [(0, self.sourceAreas[live]), (3, self.spatialIndex.getNoOfBlocks(self.sourceBounds[live])),
+                    (6, self.sourcePoints[live]), (8, self.sourceLengths[live]),
+                    (10, self.totalCooccurrences[live]), (11, self.distinctCooccurrences[live]), (12, self.realCandidates[live]),
+                    (13, self.targetCooccurrences), (14, self.targetDistinctCooccurrences), (15, self.targetCandidates)]
+        # feature 7 has always been computed from the last (live) source geometry
+        if len(self.targetData):
+            features.append((7, self.sourcePoints[live][-1:]))
+        for featureId, values in features:
+            self.maxFeatures[featureId] = -sys.float_info.max
+            self.minFeatures[featureId] = sys.float_info.max
+            self.updateFeatureRange(featureId, values)
+
+    # draws the training and verification samples from the valid pairs of a block of targets
+    def samplePairs(self, sourceIds, localIds, firstId, targetChunk):
+        for candidateMatchId, localId in zip(sourceIds.tolist(), localIds.tolist()):
+            if len(self.sample) >= 1000 and (len(self.sample_for_verification) >= 500 or self.random_number == 0):
+                break
+            targetGeomId, targetGeom = firstId + localId, targetChunk[localId]
+            if len(self.sample) < 1000:
+                  self.random_number = random.randint(0, 1)
+                  if self.random_number == 0:
+                    self.sample.append((candidateMatchId, targetGeomId, targetGeom))
+            #Create sample for verification
+            if len(self.sample_for_verification) < 500:
+                  if self.random_number == 1:
+                    self.sample_for_verification.append((candidateMatchId, targetGeomId, targetGeom))
+
+    def updateFeatureRange(self, featureId, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.maxFeatures[featureId] = max(self.maxFeatures[featureId], values.max().item())
+            self.minFeatures[featureId] = min(self.minFeatures[featureId], values.min().item())
 
     def getNoOfPoints(self, geometry):
         if isinstance(geometry, Polygon):
@@ -236,39 +206,96 @@ class Extrapolation:
             #print(geometry)
             return 0
 
+    # candidates of a single target; frequency holds the number of cells each of them shares with it
     def getCandidates(self, targetId, targetGeom):
-        candidates = set()
-
-        envelope = targetGeom.envelope.bounds
-        maxX = math.ceil(envelope[2] / self.thetaX)
-        maxY = math.ceil(envelope[3] / self.thetaY)
-        minX = math.floor(envelope[0] / self.thetaX)
-        minY = math.floor(envelope[1] / self.thetaY)
-
-        for latIndex in range(minX, maxX+1):
-          for longIndex in range(minY,maxY+1):
-              for sourceId in self.spatialIndex[latIndex][longIndex]:
-                  if (self.flag[sourceId] == -1):
-                      self.flag[sourceId] = targetId
-                      self.frequency[sourceId] = 0
-                  self.frequency[sourceId] += 1
-                  candidates.add(sourceId)
-
+        candidates, targetIds, commonBlocks = self.spatialIndex.getCandidatePairs(targetGeom.bounds, targetId)
+        self.frequency[candidates] = commonBlocks
         return candidates
 
+    # valid candidates of every target, block by block, with frequency set as getCandidates does
+    def iterCandidates(self):
+        for firstId, targetChunk, targetBounds in self.targetData.chunks():
+            self.relations.checkCancelled()
+            sourceIds, targetIds, commonBlocks = self.spatialIndex.getCandidatePairs(targetBounds, firstId)
+            valid = mbr.intersects(self.sourceBounds[sourceIds], targetBounds[targetIds - firstId])
+            limits = np.searchsorted(targetIds, np.arange(firstId, firstId + len(targetChunk) + 1)).tolist()
+            for localId, targetGeom in enumerate(targetChunk):
+                start, end = limits[localId], limits[localId + 1]
+                self.frequency[sourceIds[start:end]] = commonBlocks[start:end]
+                yield firstId + localId, targetGeom, sourceIds[start:end][valid[start:end]]
+
     def setThetas(self):
-        self.thetaX, self.thetaY = 0, 0
-        for sEntity in self.sourceData:
-            envelope = sEntity.envelope.bounds
-            self.thetaX += envelope[2] - envelope[0]
-            self.thetaY += envelope[3] - envelope[1]
-
-        self.thetaX /= len(self.sourceData)
-        self.thetaY /= len(self.sourceData)
+        self.thetaX, self.thetaY = self.getThetas()
         print("Dimensions of Equigrid", self.thetaX,"and", self.thetaY)
 
+    def getThetas(self):
+        # the adaptive grid starts from the typical extent and leaves the large geometries to its coarser levels
+        average = np.median if self.indexType == 'adaptive' else np.mean
+        bounds = self.sourceBounds[~np.isnan(self.sourceBounds).any(axis=1)]
+        return float(average(bounds[:, 2] - bounds[:, 0])), float(average(bounds[:, 3] - bounds[:, 1]))
+
+    # Changes to the source layer, applied to the index and to the preprocessing statistics in place.
+    # insertSources returns the ids given to the new geometries; deleted ids stay as empty slots.
+    def insertSources(self, geometries):
+        sourceIds = np.arange(len(self.sourceData), len(self.sourceData) + len(geometries))
+        if self.streamSources:
+            self.sourceData = self.sourceData.grow(len(geometries))
+        else:
+            self.sourceData = np.concatenate((self.sourceData, np.full(len(geometries), None, dtype=object)))
+        self.sourceBounds = np.concatenate((self.sourceBounds, np.full((len(geometries), 4), np.nan)))
+        self.sourceAreas = np.concatenate((self.sourceAreas, np.full(len(geometries), np.nan)))
+        self.sourceLengths = np.concatenate((self.sourceLengths, np.full(len(geometries), np.nan)))
+        self.sourcePoints = np.concatenate((self.sourcePoints, np.zeros(len(geometries), dtype=np.int64)))
+        for name in ('frequency', 'distinctCooccurrences', 'realCandidates', 'totalCooccurrences'):
+            setattr(self, name, np.concatenate((getattr(self, name), np.zeros(len(geometries), dtype=np.int64))))
+        self.replaceSources(sourceIds, geometries)
+        return sourceIds
+
+    def deleteSources(self, sourceIds):
+        self.replaceSources(sourceIds, [None] * len(sourceIds))
+
+    def replaceSources(self, sourceIds, geometries):
+        sourceIds = np.asarray(sourceIds, dtype=np.int64)
+        newGeometries = np.empty(len(sourceIds), dtype=object)
+        newGeometries[:] = list(geometries)
+        # the index and the statistics no longer match the source file
+        self.sourceIndexPath = None
+
+        self.addSourcePairStatistics(sourceIds, -1)
+        for name in ('sourceBounds', 'sourceAreas', 'sourceLengths', 'sourcePoints'):
+            if not getattr(self, name).flags.writeable:
+                setattr(self, name, np.array(getattr(self, name)))
+        self.sourceData[sourceIds] = newGeometries
+        self.sourceBounds[sourceIds] = shapely.bounds(newGeometries)
+        self.sourceAreas[sourceIds] = mbr.getAreas(self.sourceBounds[sourceIds])
+        self.sourceLengths[sourceIds] = shapely.length(newGeometries)
+        self.sourcePoints[sourceIds] = [self.getNoOfPoints(geometry) for geometry in newGeometries]
+        changed = set(sourceIds.tolist())
+        self.sample = [pair for pair in self.sample if pair[0] not in changed]
+        self.sample_for_verification = [pair for pair in self.sample_for_verification if pair[0] not in changed]
+
+        thetaX, thetaY = self.getThetas()
+        if self.THETA_DRIFT < max(abs(thetaX - self.thetaX) / self.thetaX, abs(thetaY - self.thetaY) / self.thetaY):
+            # new cell sizes change the common blocks of every pair
+            self.setThetas()
+            self.indexSource()
+            self.sample, self.sample_for_verification = [], []
+            self.preprocessing()
+            return
+        self.spatialIndex.update(self.sourceBounds, sourceIds)
+        self.addSourcePairStatistics(sourceIds, 1)
+        self.setFeatureRanges()
+
+    # co-occurrences of the given sources with all targets, through an index over those sources alone
+    def addSourcePairStatistics(self, sourceIds, sign):
+        sourceIndex = createIndex(self.indexType, self.thetaX, self.thetaY, upperInclusive = True).build(self.sourceBounds[sourceIds])
+        for firstId, targetChunk, targetBounds in self.targetData.chunks():
+            changedIds, localIds, commonBlocks = sourceIndex.getCandidatePairs(targetBounds)
+            self.addPairStatistics(sourceIds[changedIds], localIds, commonBlocks, targetBounds, firstId, sign)
+            self.totalCandidatePairs += sign * len(changedIds)
+
     def validCandidate(self, candidateId, targetEnv):
-        return self.sourceData[candidateId].envelope.intersects(targetEnv)
+        return bool(mbr.intersects(self.sourceBounds[candidateId], targetEnv.bounds)[0])
 
     def trainModel(self):
         self.trainingPhase = True
@@ -322,79 +349,76 @@ class Extrapolation:
         self.trainingPhase = False
 
     def get_feature_vector(self, sourceId, targetId, targetGeom):
-        featureVector = [0] * (self.NO_OF_FEATURES)
+        return self.get_feature_vectors([sourceId], targetId, targetGeom)[0].tolist()
+
+    # feature vectors of several candidates of the same target, one row per candidate
+    def get_feature_vectors(self, sourceIds, targetId, targetGeom):
+        sourceIds = np.asarray(sourceIds, dtype=np.int64)
+        sourceBounds = self.sourceBounds[sourceIds]
+        targetBounds = np.array([targetGeom.bounds])
+        featureVectors = np.zeros((len(sourceIds), self.NO_OF_FEATURES))
 
         if(self.trainingPhase == 1):
           candidateMatches = self.getCandidates(targetId, targetGeom)
-          for candidateMatchId in candidateMatches:
-            featureVector[13] += self.frequency[candidateMatchId]
-            featureVector[14]+=1
-            if (self.validCandidate(candidateMatchId, targetGeom.envelope)): # intersecting MBRs
-                  featureVector[15]+=1
-
-        mbrIntersection = self.sourceData[sourceId].envelope.intersection(targetGeom.envelope)
+          featureVectors[:, 13] = self.frequency[candidateMatches].sum()
+          featureVectors[:, 14] = len(candidateMatches)
+          featureVectors[:, 15] = np.count_nonzero(mbr.intersects(self.sourceBounds[candidateMatches], targetBounds)) # intersecting MBRs
 
         #area-based features
-        featureVector[0] = (self.sourceData[sourceId].envelope.area - self.minFeatures[0]) / self.maxFeatures[0] * 10000  # source area
-        featureVector[1] = (targetGeom.envelope.area - self.minFeatures[1]) / self.maxFeatures[1] * 10000  # target area
-        featureVector[2] = (mbrIntersection.area - self.minFeatures[2]) / self.maxFeatures[2] * 10000  # intersection area
+        featureVectors[:, 0] = (self.sourceAreas[sourceIds] - self.minFeatures[0]) / self.maxFeatures[0] * 10000  # source area
+        featureVectors[:, 1] = (mbr.getAreas(targetBounds) - self.minFeatures[1]) / self.maxFeatures[1] * 10000  # target area
+        featureVectors[:, 2] = (mbr.getIntersectionAreas(sourceBounds, targetBounds) - self.minFeatures[2]) / self.maxFeatures[2] * 10000  # intersection area
 
         #grid-based features
-        featureVector[3] = (self.getNoOfBlocks(self.sourceData[sourceId].bounds) - self.minFeatures[3]) / self.maxFeatures[3] * 10000 # source blocks
-        featureVector[4] = (self.getNoOfBlocks(targetGeom.bounds) - self.minFeatures[4]) / self.maxFeatures[4] * 10000 # source blocks
-        featureVector[5] = (self.frequency[sourceId] - self.minFeatures[5]) / self.maxFeatures[5] * 10000 # common blocks
+        featureVectors[:, 3] = (self.spatialIndex.getNoOfBlocks(sourceBounds) - self.minFeatures[3]) / self.maxFeatures[3] * 10000 # source blocks
+        featureVectors[:, 4] = (self.getNoOfBlocks(targetGeom.bounds) - self.minFeatures[4]) / self.maxFeatures[4] * 10000 # source blocks
+        featureVectors[:, 5] = (self.frequency[sourceIds] - self.minFeatures[5]) / self.maxFeatures[5] * 10000 # common blocks
 
         # boundary-based features
-        featureVector[7] = (self.getNoOfPoints(self.sourceData[sourceId]) - self.minFeatures[7]) / self.maxFeatures[7] * 10000 # source boundary points
-        featureVector[8] = (self.getNoOfPoints(targetGeom) - self.minFeatures[8]) / self.maxFeatures[8] * 10000 # target boundary points
-        featureVector[9] = (targetGeom.length - self.minFeatures[9]) / self.maxFeatures[9] * 10000 # source length
-        featureVector[6] = (self.sourceData[sourceId].length - self.minFeatures[6]) / self.maxFeatures[6] * 10000  # target length
+        featureVectors[:, 7] = (self.sourcePoints[sourceIds] - self.minFeatures[7]) / self.maxFeatures[7] * 10000 # source boundary points
+        featureVectors[:, 8] = (self.getNoOfPoints(targetGeom) - self.minFeatures[8]) / self.maxFeatures[8] * 10000 # target boundary points
+        featureVectors[:, 9] = (targetGeom.length - self.minFeatures[9]) / self.maxFeatures[9] * 10000 # source length
+        featureVectors[:, 6] = (self.sourceLengths[sourceIds] - self.minFeatures[6]) / self.maxFeatures[6] * 10000  # target length
         #candidate-based features
         #source geometry
-        featureVector[10] = (self.totalCooccurrences[sourceId] - self.minFeatures[10]) / self.maxFeatures[10] * 10000
-        featureVector[11] = (self.distinctCooccurrences[sourceId] - self.minFeatures[11]) / self.maxFeatures[11] * 10000
-        featureVector[12] = (self.realCandidates[sourceId] - self.minFeatures[12]) / self.maxFeatures[12] * 10000
+        featureVectors[:, 10] = (self.totalCooccurrences[sourceIds] - self.minFeatures[10]) / self.maxFeatures[10] * 10000
+        featureVectors[:, 11] = (self.distinctCooccurrences[sourceIds] - self.minFeatures[11]) / self.maxFeatures[11] * 10000
+        featureVectors[:, 12] = (self.realCandidates[sourceIds] - self.minFeatures[12]) / self.maxFeatures[12] * 10000
         #target geometry
-        featureVector[13] = (featureVector[13] - self.minFeatures[13]) / self.maxFeatures[13] * 10000
-        featureVector[14] = (featureVector[14] - self.minFeatures[14]) / self.maxFeatures[14] * 10000
-        featureVector[15] = (featureVector[15] - self.minFeatures[15]) / self.maxFeatures[15] * 10000
+        featureVectors[:, 13] = (featureVectors[:, 13] - self.minFeatures[13]) / self.maxFeatures[13] * 10000
+        featureVectors[:, 14] = (featureVectors[:, 14] - self.minFeatures[14]) / self.maxFeatures[14] * 10000
+        featureVectors[:, 15] = (featureVectors[:, 15] - self.minFeatures[15]) / self.maxFeatures[15] * 10000
 
-        return featureVector
+        return featureVectors
 
     def getNoOfBlocks(self, envelope) :
-      maxX = math.ceil(envelope[2] / self.thetaX)
-      maxY = math.ceil(envelope[3] / self.thetaY)
-      minX = math.floor(envelope[0] / self.thetaX)
-      minY = math.floor(envelope[1] / self.thetaY)
-      return (maxX - minX + 1) * (maxY - minY + 1)
+      return int(self.spatialIndex.getNoOfBlocks(envelope)[0])
+
+    # verifies (source id, target id, target geometry) triples, VERIFICATION_BATCH of them per relate call;
+    # returns which of them are related
+    def verifyPairs(self, pairs):
+        related = [np.zeros(0, dtype=bool)]
+        for start in range(0, len(pairs), self.VERIFICATION_BATCH):
+            sourceIds, targetIds, targetGeoms = zip(*pairs[start:start + self.VERIFICATION_BATCH])
+            targetGeoms = np.array(targetGeoms, dtype=object)
+            related.append(self.relations.verifyRelationsBatch(sourceIds, targetIds, self.sourceData[list(sourceIds)], targetGeoms))
+        return np.concatenate(related)
 
     def verification(self):
         Prediction_probs, retainedPairs = [], []
         maxsize = self.users_input * (self.detectedQP/ 1000) * self.totalCandidatePairs
-        self.topKPairs = PriorityQueue(maxsize + 1)
-        minimumWeight = -1
         targetId, totalDecisions, positiveDecisions, truePositiveDecisions = 0, 0, 0, 0
-        targetData = CsvReader.readAllEntities("\t", self.targetFilePath)
-        for targetGeom in targetData:
-          candidates = self.getCandidates(targetId,targetGeom)
-          for candidateMatchId in candidates:
-                    if (self.validCandidate(candidateMatchId, targetGeom.envelope)):
-                        currentInstance = self.get_feature_vector(candidateMatchId, targetId, targetGeom)
-                        weight = self.classifier.predict(np.array([currentInstance]))
-                        #insert into priority queu with size K=maxVerifications
-                        #the priority queue stores the pairs in decreasing weight
-                        if (minimumWeight <= weight):
-                          self.topKPairs.put((weight, candidateMatchId, targetId, targetGeom)) 
-                          if (maxsize < self.topKPairs.qsize()):
-                              minimumWeight = self.topKPairs.get()[0]
-          targetId += 1
-
-        #verify the K pairs in the priority queue
-        counter = 0
-        while(not self.topKPairs.empty()):
-            counter += 1
-            weight, source_id, target_id, tEntity = self.topKPairs.get()
-            self.relations.verifyRelations(candidateMatchId, targetId, self.sourceData[candidateMatchId], targetGeom)
-            if (maxsize == counter):
-              break
+        # the spilled runs are removed on the way out, however the classification or verification ends
+        with SpillingTopKPairs(maxsize, self.topKMemoryLimit, self.spillDirectory) as self.topKPairs:
+          for targetId, targetGeom, candidates in self.iterCandidates():
+            if len(candidates) == 0:
+              continue
+            # all candidates of a target are classified in one call
+            instances = self.get_feature_vectors(candidates, targetId, targetGeom)
+            #insert into the top-K with size K=maxVerifications
+            self.topKPairs.add(self.classifier.predict(instances), candidates, targetId)
+
+          #verify the K pairs in the top-K, which never holds more than maxsize of them, streamed back in weight order
+          for weights, sourceIds, targetIds in self.topKPairs.iterPairs(self.VERIFICATION_BATCH):
+            self.verifyPairs(list(zip(sourceIds.tolist(), targetIds.tolist(), self.targetData.getGeometries(targetIds))))
 
@@ -0,0 +1,44 @@
+import numpy as np
+from topk import TopKPairs, SpillingTopKPairs
+
+# Checks that SpillingTopKPairs gives the pairs of the in-memory TopKPairs when it spills to disk.
+#
+#   python test_topk.py
+
+def getSpilledPairs(k, weights, sourceIds, targetIds, chunkSize = 7):
+    # room for 8 pairs, so that every few pairs spill
+    with SpillingTopKPairs(k, memoryLimit = 8 * SpillingTopKPairs.PAIR_BYTES) as topKPairs:
+        for start in range(0, len(weights), 5):
+            topKPairs.add(weights[start:start + 5], sourceIds[start:start + 5], targetIds[start:start + 5])
+        chunks = list(topKPairs.iterPairs(chunkSize))
+    return [np.concatenate([chunk[column] for chunk in chunks]) for column in range(3)]
+
+def getPairs(k, weights, sourceIds, targetIds):
+    topKPairs = TopKPairs(k)
+    topKPairs.add(weights, sourceIds, targetIds)
+    return topKPairs.getPairs()
+
+def test_signed_zeros():
+    rng = np.random.default_rng(0)
+    for k in (1, 10, 50, 150):
+        weights = rng.choice([-0.0, 0.0, -1.0, 1.0, 0.5], 200)
+        sourceIds, targetIds = rng.permutation(200), rng.integers(0, 20, 200)
+        expected = getPairs(k, weights, sourceIds, targetIds)
+        spilled = getSpilledPairs(k, weights, sourceIds, targetIds)
+        for column in range(3):
+            assert spilled[column].tolist() == expected[column].tolist()
+
+def test_random_weights():
+    rng = np.random.default_rng(1)
+    for k in (1, 10, 50, 150):
+        weights = rng.integers(0, 8, 200).astype(np.float64)
+        sourceIds, targetIds = rng.permutation(200), rng.integers(0, 20, 200)
+        expected = getPairs(k, weights, sourceIds, targetIds)
+        spilled = getSpilledPairs(k, weights, sourceIds, targetIds)
+        for column in range(3):
+            assert spilled[column].tolist() == expected[column].tolist()
+
+if __name__ == '__main__':
+    test_signed_zeros()
+    test_random_weights()
+    print("ok")
@@ -1,7 +1,16 @@
 import csv
-from shapely.geometry import shape
-from shapely.wkt import loads
+import hashlib
+import io
+import json
+import numpy as np
+import os
+import shapely
 import sys
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from geometrystore import WKBStore
+from itertools import repeat
 
 maxInt = sys.maxsize
 while True:
@@ -11,26 +20,449 @@ while True:
     except OverflowError:
         maxInt = int(maxInt/10)
 
+class LoadedEntities:
+    def __init__(self, geometries, bounds, failed, geoCollections):
+        self.geometries = geometries    # numpy object array of shapely geometries
+        self.bounds = bounds            # (n, 4) float64 array of minX, minY, maxX, maxY
+        self.failed = failed
+        self.geoCollections = geoCollections
+
+    def __len__(self):
+        return len(self.geometries)
+
 class CsvReader:
-    def readAllEntities(delimiter, inputFilePath):
-        loadedEntities = []
-        geoCollections = 0
-        lineCount = 0  # Counter for lines read
+    BATCH_SIZE = 100000
+    CACHE_SUFFIX = '.geocache'
+    HASHED_BYTES = 1 << 20
+
+    def readAllEntities(delimiter, inputFilePath, workers = 1):
+        return list(CsvReader.loadAllEntities(delimiter, inputFilePath, workers = workers).geometries)
+
+    # GeoParquet and Arrow IPC inputs are picked by file extension; they already carry WKB,
+    # so they bypass the sidecar cache and are decoded directly
+    def loadAllEntities(delimiter, inputFilePath, batchSize = BATCH_SIZE, useCache = True, workers = 1):
+        if not useCache or GeoArrowReader.isArrowFile(inputFilePath):
+            return CsvReader.parseFile(delimiter, inputFilePath, batchSize, workers)
+
+        store = CsvReader.openCachedStore(delimiter, inputFilePath)
+        if store is not None:
+            return LoadedEntities(store.decode(), store.bounds, store.metadata['failed'], store.metadata['geoCollections'])
+
+        entities = CsvReader.parseFile(delimiter, inputFilePath, batchSize, workers)
+        cachePath = inputFilePath + CsvReader.CACHE_SUFFIX
+        try:
+            WKBStore.write(cachePath, entities.geometries, entities.bounds,
+                           {'key': CsvReader.getCacheKey(delimiter, inputFilePath), 'failed': entities.failed, 'geoCollections': entities.geoCollections})
+        except OSError as e:
+            print("Could not write geometry cache", cachePath, e)
+        return entities
+
+    def openCachedStore(delimiter, inputFilePath):
+        key = CsvReader.getCacheKey(delimiter, inputFilePath)
+        for cachePath in (inputFilePath + CsvReader.CACHE_SUFFIX, CsvReader.getFallbackCachePath(inputFilePath)):
+            store = WKBStore.open(cachePath)
+            if store is not None and store.metadata.get('key') == key:
+                return store
+        return None
 
+    # where the cache goes when the directory of the input is not writable: a name in the temp
+    # directory that depends only on the input path, so later runs reuse it and rebuilds replace it
+    def getFallbackCachePath(inputFilePath):
+        pathDigest = hashlib.blake2b(os.path.abspath(inputFilePath).encode(), digest_size=8).hexdigest()
+        return os.path.join(tempfile.gettempdir(), '%s.%s%s' % (os.path.basename(inputFilePath), pathDigest, CsvReader.CACHE_SUFFIX))
+
+    # returns the memory-mapped cache of the input, building it chunk by chunk
+    # if needed so that the input is never fully resident
+    def openStore(delimiter, inputFilePath, batchSize = BATCH_SIZE):
+        store = CsvReader.openCachedStore(delimiter, inputFilePath)
+        if store is not None:
+            return store
+
+        metadata = {'key': CsvReader.getCacheKey(delimiter, inputFilePath), 'failed': 0, 'geoCollections': 0}
+        def chunks():
+            if GeoArrowReader.isArrowFile(inputFilePath):
+                for wkbs, bounds, failed, geoCollections in GeoArrowReader.iterWKBChunks(inputFilePath, batchSize):
+                    metadata['failed'] += failed
+                    metadata['geoCollections'] += geoCollections
+                    yield wkbs, bounds
+                return
+            for entities in CsvReader.iterChunks(delimiter, inputFilePath, batchSize):
+                metadata['failed'] += entities.failed
+                metadata['geoCollections'] += entities.geoCollections
+                yield shapely.to_wkb(entities.geometries), entities.bounds
+
+        cachePath = inputFilePath + CsvReader.CACHE_SUFFIX
+        try:
+            WKBStore.writeChunks(cachePath, chunks(), metadata)
+        except OSError as e:
+            print("Could not write geometry cache", cachePath, e)
+            cachePath = CsvReader.getFallbackCachePath(inputFilePath)
+            metadata['failed'], metadata['geoCollections'] = 0, 0
+            WKBStore.writeChunks(cachePath, chunks(), metadata)
+        return WKBStore.open(cachePath)
+
+    # size and mtime catch ordinary rewrites, the hash of the first and last
+    # block catches in-place edits that preserve both
+    def getCacheKey(delimiter, inputFilePath):
+        stat = os.stat(inputFilePath)
+        digest = hashlib.blake2b(digest_size=16)
+        with open(inputFilePath, 'rb') as f:
+            digest.update(f.read(CsvReader.HASHED_BYTES))
+            if CsvReader.HASHED_BYTES < stat.st_size:
+                f.seek(max(CsvReader.HASHED_BYTES, stat.st_size - CsvReader.HASHED_BYTES))
+                digest.update(f.read(CsvReader.HASHED_BYTES))
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': digest.hexdigest(), 'delimiter': delimiter}
+
+    def parseFile(delimiter, inputFilePath, batchSize = BATCH_SIZE, workers = 1):
+        if GeoArrowReader.isArrowFile(inputFilePath):
+            return CsvReader.concatenate(list(GeoArrowReader.iterChunks(inputFilePath, batchSize)))
+        if 1 < workers:
+            return CsvReader.parseFileParallel(delimiter, inputFilePath, batchSize, workers)
+        return CsvReader.concatenate(list(CsvReader.iterChunks(delimiter, inputFilePath, batchSize)))
+
+    # yields the loaded entities of every batchSize rows, always at least one (possibly empty) chunk
+    def iterChunks(delimiter, inputFilePath, batchSize = BATCH_SIZE):
+        if GeoArrowReader.isArrowFile(inputFilePath):
+            yield from GeoArrowReader.iterChunks(inputFilePath, batchSize)
+            return
         with open(inputFilePath, newline='') as f:
-            reader = csv.reader(f, delimiter=delimiter)
-            for row in reader:
-                try:
-                    geometry, *information = [s.split(delimiter)[0] for s in row]
-                    geometry = shape(loads(geometry))
-                except:
-                    print("failed")
+            yield from CsvReader.parseRows(csv.reader(f, delimiter=delimiter), delimiter, batchSize)
+
+    def parseRows(reader, delimiter, batchSize):
+        wktBatch, emptyRows, chunks = [], 0, 0
+        for row in reader:
+            if not row:
+                emptyRows += 1
+                continue
+            wktBatch.append(row[0].split(delimiter)[0])
+            if len(wktBatch) == batchSize:
+                entities = CsvReader.parseBatch(wktBatch)
+                entities.failed += emptyRows
+                wktBatch, emptyRows, chunks = [], 0, chunks + 1
+                yield entities
+        if wktBatch or emptyRows or not chunks:
+            entities = CsvReader.parseBatch(wktBatch)
+            entities.failed += emptyRows
+            yield entities
+
+    # Splits the input into newline-aligned byte ranges that are parsed in worker processes and
+    # concatenated in file order, so geometry ids match the serial reader. Assumes that no
+    # quoted field spans lines, which holds for WKT.
+    def parseFileParallel(delimiter, inputFilePath, batchSize = BATCH_SIZE, workers = os.cpu_count()):
+        ranges = CsvReader.getByteRanges(inputFilePath, 4 * workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(CsvReader.parseByteRange, repeat(delimiter), repeat(inputFilePath), ranges, repeat(batchSize)))
+        entities = CsvReader.concatenate(parts)
+        entities.geometries = shapely.from_wkb(entities.geometries)
+        return entities
+
+    def getByteRanges(inputFilePath, noOfRanges):
+        fileSize = os.path.getsize(inputFilePath)
+        boundaries = [0]
+        with open(inputFilePath, 'rb') as f:
+            for i in range(1, noOfRanges):
+                position = fileSize * i // noOfRanges
+                if position <= boundaries[-1]:
                     continue
-                if geometry.geom_type == "GeometryCollection":
-                    geoCollections += 1
-                else:
-                    #print(geometry)
-                    #print(type(geometry))
-                    loadedEntities.append(geometry)
-
-        return loadedEntities
+                # a range starts right after the newline that ends the line containing position - 1
+                f.seek(position - 1)
+                f.readline()
+                if fileSize <= f.tell():
+                    break
+                if boundaries[-1] < f.tell():
+                    boundaries.append(f.tell())
+        boundaries.append(fileSize)
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def parseByteRange(delimiter, inputFilePath, byteRange, batchSize):
+        with open(inputFilePath, 'rb') as f:
+            f.seek(byteRange[0])
+            data = f.read(byteRange[1] - byteRange[0])
+        with io.TextIOWrapper(io.BytesIO(data), newline='') as text:
+            entities = CsvReader.concatenate(list(CsvReader.parseRows(csv.reader(text, delimiter=delimiter), delimiter, batchSize)))
+        # WKB crosses the process boundary far cheaper than pickled geometries
+        entities.geometries = shapely.to_wkb(entities.geometries)
+        return entities
+
+    def parseBatch(wktBatch):
+        return CsvReader.filterGeometries(shapely.from_wkt(np.array(wktBatch, dtype=object), on_invalid='ignore'))
+
+    # drops unparsable geometries and GeometryCollections, counting both
+    def filterGeometries(geometries, bounds = None):
+        typeIds = shapely.get_type_id(geometries)
+        isMissing = typeIds == shapely.GeometryType.MISSING
+        isCollection = typeIds == shapely.GeometryType.GEOMETRYCOLLECTION
+
+        loaded = ~(isMissing | isCollection)
+        geometries = geometries[loaded]
+        if bounds is None:
+            bounds = shapely.bounds(geometries).reshape(-1, 4)
+        else:
+            bounds = bounds[loaded]
+        return LoadedEntities(geometries, bounds, int(np.count_nonzero(isMissing)), int(np.count_nonzero(isCollection)))
+
+    def concatenate(batches):
+        if len(batches) == 1:
+            return batches[0]
+        return LoadedEntities(np.concatenate([b.geometries for b in batches]),
+                              np.concatenate([b.bounds for b in batches]),
+                              sum(b.failed for b in batches),
+                              sum(b.geoCollections for b in batches))
+
+class GeoArrowReader:
+    EXTENSIONS = ('.parquet', '.geoparquet', '.arrow', '.feather', '.ipc')
+    BBOX_FIELDS = ('xmin', 'ymin', 'xmax', 'ymax')
+
+    def isArrowFile(inputFilePath):
+        return os.path.splitext(inputFilePath)[1].lower() in GeoArrowReader.EXTENSIONS
+
+    def loadAllEntities(inputFilePath, batchSize = CsvReader.BATCH_SIZE):
+        return CsvReader.concatenate(list(GeoArrowReader.iterChunks(inputFilePath, batchSize)))
+
+    def iterChunks(inputFilePath, batchSize = CsvReader.BATCH_SIZE):
+        chunks = 0
+        for batch, geometryColumn, bboxPaths in GeoArrowReader.iterBatches(inputFilePath, batchSize):
+            chunks += 1
+            yield GeoArrowReader.parseBatch(batch, geometryColumn, bboxPaths)
+        if not chunks:
+            yield CsvReader.parseBatch([])
+
+    # reads only the geometry column and, if present, the bbox covering columns
+    def iterBatches(inputFilePath, batchSize):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("Reading " + inputFilePath + " requires pyarrow") from e
+
+        if inputFilePath.lower().endswith(('.parquet', '.geoparquet')):
+            parquetFile = pyarrow.parquet.ParquetFile(inputFilePath)
+            geometryColumn, bboxPaths = GeoArrowReader.getColumns(parquetFile.schema_arrow)
+            columns = GeoArrowReader.getProjection(geometryColumn, bboxPaths)
+            for batch in parquetFile.iter_batches(batch_size=batchSize, columns=columns):
+                yield batch, geometryColumn, bboxPaths
+        else:
+            with pyarrow.memory_map(inputFilePath) as source:
+                reader = pyarrow.ipc.open_file(source)
+                geometryColumn, bboxPaths = GeoArrowReader.getColumns(reader.schema)
+                columns = GeoArrowReader.getProjection(geometryColumn, bboxPaths)
+                for i in range(reader.num_record_batches):
+                    batch = reader.get_batch(i).select(columns)
+                    for offset in range(0, batch.num_rows, batchSize):
+                        yield batch.slice(offset, batchSize), geometryColumn, bboxPaths
+
+    def getProjection(geometryColumn, bboxPaths):
+        columns = [geometryColumn]
+        for path in bboxPaths or []:
+            if path[0] not in columns:
+                columns.append(path[0])
+        return columns
+
+    # Follows the GeoParquet "geo" metadata: the primary column holds WKB and an optional bbox
+    # covering names the columns with each geometry's extent. Without metadata, a WKB column
+    # named "geometry" and a struct column "bbox" with xmin/ymin/xmax/ymax fields are assumed.
+    def getColumns(schema):
+        metadata = schema.metadata or {}
+        geometryColumn, covering = 'geometry', None
+        if b'geo' in metadata:
+            geo = json.loads(metadata[b'geo'])
+            geometryColumn = geo.get('primary_column', geometryColumn)
+            columnMetadata = geo.get('columns', {}).get(geometryColumn, {})
+            encoding = columnMetadata.get('encoding', 'WKB')
+            if encoding.upper() != 'WKB':
+                raise ValueError("Unsupported geometry encoding " + encoding + " in column " + geometryColumn)
+            covering = columnMetadata.get('covering', {}).get('bbox')
+
+        if geometryColumn not in schema.names:
+            raise ValueError("No geometry column " + geometryColumn + " in " + str(schema.names))
+        if covering is not None:
+            return geometryColumn, [covering[field] for field in GeoArrowReader.BBOX_FIELDS]
+        if 'bbox' in schema.names:
+            bboxType = schema.field('bbox').type
+            if set(GeoArrowReader.BBOX_FIELDS) <= {bboxType.field(i).name for i in range(bboxType.num_fields)}:
+                return geometryColumn, [['bbox', field] for field in GeoArrowReader.BBOX_FIELDS]
+        return geometryColumn, None
+
+    def parseBatch(batch, geometryColumn, bboxPaths):
+        geometries = shapely.from_wkb(batch.column(geometryColumn).to_numpy(zero_copy_only=False), on_invalid='ignore')
+        if bboxPaths is None:
+            return CsvReader.filterGeometries(geometries)
+
+        bounds = GeoArrowReader.getBboxBounds(batch, bboxPaths)
+        # rows without a bbox fall back to the decoded geometry
+        noBbox = np.isnan(bounds).any(axis=1)
+        if noBbox.any():
+            bounds[noBbox] = shapely.bounds(geometries[noBbox])
+        return CsvReader.filterGeometries(geometries, bounds)
+
+    def getBboxBounds(batch, bboxPaths):
+        bounds = np.empty((batch.num_rows, 4))
+        for i, path in enumerate(bboxPaths):
+            column = batch.column(path[0])
+            for field in path[1:]:
+                column = column.field(field)
+            bounds[:, i] = column.to_numpy(zero_copy_only=False)
+        return bounds
+
+    # Yields (WKB, bounds, failed, geoCollections) for every batch, for building a WKBStore: the
+    # WKB is copied as it is, and with bbox columns only the rows without a bbox are decoded, for
+    # their bounds. Unparsable values and GeometryCollections are told by their WKB header, so a
+    # value corrupted past its header is found only when the store decodes it.
+    def iterWKBChunks(inputFilePath, batchSize = CsvReader.BATCH_SIZE):
+        for batch, geometryColumn, bboxPaths in GeoArrowReader.iterBatches(inputFilePath, batchSize):
+            wkbs = batch.column(geometryColumn).to_numpy(zero_copy_only=False)
+            if bboxPaths is None:
+                geometries = shapely.from_wkb(wkbs, on_invalid='ignore')
+                typeIds = shapely.get_type_id(geometries)
+                isMissing = typeIds == shapely.GeometryType.MISSING
+                isCollection = typeIds == shapely.GeometryType.GEOMETRYCOLLECTION
+                bounds = shapely.bounds(geometries).reshape(-1, 4)
+            else:
+                wkbTypes = GeoArrowReader.getWKBTypes(wkbs)
+                isMissing = (wkbTypes < 1) | (7 < wkbTypes)
+                isCollection = wkbTypes == 7
+                bounds = GeoArrowReader.getBboxBounds(batch, bboxPaths)
+                noBbox = np.isnan(bounds).any(axis=1) & ~isMissing & ~isCollection
+                if noBbox.any():
+                    geometries = shapely.from_wkb(wkbs[noBbox], on_invalid='ignore')
+                    bounds[noBbox] = shapely.bounds(geometries)
+                    isMissing[np.flatnonzero(noBbox)[shapely.is_missing(geometries)]] = True
+            loaded = ~(isMissing | isCollection)
+            yield wkbs[loaded], bounds[loaded], int(np.count_nonzero(isMissing)), int(np.count_nonzero(isCollection))
+
+    # WKB geometry type codes 1 (Point) to 7 (GeometryCollection) from the headers, with the ISO
+    # and EWKB dimension flags dropped; -1 for null or truncated values
+    def getWKBTypes(wkbs):
+        wkbTypes = np.full(len(wkbs), -1, dtype=np.int64)
+        for i, wkb in enumerate(wkbs):
+            if wkb is not None and 5 <= len(wkb) and wkb[0] in (0, 1):
+                wkbTypes[i] = (int.from_bytes(wkb[1:5], 'little' if wkb[0] else 'big') & 0x0fffffff) % 1000
+        return wkbTypes
+
+class TargetData:
+    def __init__(self, delimiter, targetFilePath, streaming = False, chunkSize = CsvReader.BATCH_SIZE, workers = 1):
+        self.delimiter = delimiter
+        self.targetFilePath = targetFilePath
+        self.streaming = streaming
+        self.chunkSize = chunkSize
+        self.workers = workers
+        self.entities = None
+        self.store = None
+
+    # the first access loads the targets (or maps their cache when streaming); later phases reuse them
+    def load(self):
+        if self.streaming:
+            if self.store is None:
+                self.store = CsvReader.openStore(self.delimiter, self.targetFilePath, self.chunkSize)
+        elif self.entities is None:
+            self.entities = CsvReader.loadAllEntities(self.delimiter, self.targetFilePath, self.chunkSize, workers = self.workers)
+        return self
+
+    def __len__(self):
+        self.load()
+        return len(self.store) if self.streaming else len(self.entities)
+
+    def __getitem__(self, targetId):
+        self.load()
+        if self.streaming:
+            return self.store.decode([targetId])[0]
+        return self.entities.geometries[targetId]
+
+    def getGeometries(self, targetIds):
+        self.load()
+        if self.streaming:
+            return self.store.decode(targetIds)
+        return self.entities.geometries[np.asarray(targetIds, dtype=np.int64)]
+
+    def __iter__(self):
+        for firstId, geometries, bounds in self.chunks():
+            yield from geometries
+
+    def getBounds(self):
+        self.load()
+        return self.store.bounds if self.streaming else self.entities.bounds
+
+    # yields (id of the first target, geometries, bounds) for consecutive blocks of targets
+    def chunks(self, chunkSize = None):
+        self.load()
+        chunkSize = chunkSize or self.chunkSize
+        bounds = self.getBounds()
+        for firstId in range(0, len(self), chunkSize):
+            lastId = min(firstId + chunkSize, len(self))
+            if self.streaming:
+                geometries = self.store.decode(range(firstId, lastId))
+            else:
+                geometries = self.entities.geometries[firstId:lastId]
+            yield firstId, geometries, bounds[firstId:lastId]
+
+# Source geometries kept out of core: they stay in the memory-mapped cache of the input and are
+# decoded on access, with the last CACHE_SIZE of them kept in an LRU cache. It stands in for the
+# array of source geometries (len, iteration, indexing by id or by an array of ids); geometries
+# set after loading, and slots appended by grow, are held in memory apart from the store.
+class SourceData:
+    CACHE_SIZE = 1 << 16
+
+    def __init__(self, delimiter, sourceFilePath, chunkSize = CsvReader.BATCH_SIZE, cacheSize = CACHE_SIZE):
+        self.store = CsvReader.openStore(delimiter, sourceFilePath, chunkSize)
+        self.chunkSize = chunkSize
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()
+        self.changed = {}
+        self.noOfGeometries = len(self.store)
+
+    def __len__(self):
+        return self.noOfGeometries
+
+    def getBounds(self):
+        return self.store.bounds
+
+    def getGeometry(self, sourceId):
+        if sourceId in self.changed:
+            return self.changed[sourceId]
+        geometry = self.cache.get(sourceId)
+        if geometry is None:
+            geometry = self.store.decode([sourceId])[0]
+            self.cache[sourceId] = geometry
+            if self.cacheSize < len(self.cache):
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(sourceId)
+        return geometry
+
+    def __getitem__(self, sourceIds):
+        if np.ndim(sourceIds) == 0:
+            return self.getGeometry(int(sourceIds))
+        geometries = np.empty(len(sourceIds), dtype=object)
+        geometries[:] = [self.getGeometry(sourceId) for sourceId in np.asarray(sourceIds, dtype=np.int64).tolist()]
+        return geometries
+
+    def __setitem__(self, sourceIds, geometries):
+        sourceIds = np.atleast_1d(np.asarray(sourceIds, dtype=np.int64)).tolist()
+        geometries = [geometries] if len(sourceIds) == 1 and not isinstance(geometries, (list, np.ndarray)) else list(geometries)
+        for sourceId, geometry in zip(sourceIds, geometries):
+            self.changed[sourceId] = geometry
+            self.cache.pop(sourceId, None)
+
+    # appends count empty slots, for geometries inserted after loading
+    def grow(self, count):
+        for sourceId in range(self.noOfGeometries, self.noOfGeometries + count):
+            self.changed[sourceId] = None
+        self.noOfGeometries += count
+        return self
+
+    def __iter__(self):
+        for firstId, geometries in self.chunks():
+            yield from geometries
+
+    # yields (id of the first source, geometries) for consecutive blocks, bypassing the cache
+    def chunks(self):
+        for firstId in range(0, self.noOfGeometries, self.chunkSize):
+            lastId = min(firstId + self.chunkSize, self.noOfGeometries)
+            geometries = np.empty(lastId - firstId, dtype=object)
+            stored = min(lastId, len(self.store))
+            if firstId < stored:
+                geometries[:stored - firstId] = self.store.decode(range(firstId, stored))
+            for sourceId in self.changed:
+                if firstId <= sourceId < lastId:
+                    geometries[sourceId - firstId] = self.changed[sourceId]
+            yield firstId, geometries
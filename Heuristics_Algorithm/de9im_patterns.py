@@ -1,4 +1,6 @@
 from functools import reduce
+import numpy as np
+import shapely
 
 DIMS = {
     'F': frozenset('F'),
@@ -78,3 +80,66 @@ touches = NOrPattern(['FT*******', 'F**T*****', 'F***T****'])
 within = Pattern('T*F**F***')
 covered_by = NOrPattern(['T*F**F***','*TF**F***','**FT*F***','**F*TF***'])
 covers =  NOrPattern(['T*****FF*',	'*T****FF*',	'***T**FF*',	'****T*FF*'])
+
+
+# Compiled matcher for all the relations RelatedGeometries records
+# ---------------------------------------------------------------------
+INTERSECTS, WITHIN, COVERED_BY, CROSSES, OVERLAPS, EQUALS, TOUCHES, CONTAINS, COVERS = (1 << i for i in range(9))
+
+class RelationMatcher(object):
+    # relations is a list of (bit, patterns) pairs; a relation holds when any of its patterns matches
+    def __init__(self, relations):
+        self.relations = [(bit, [RelationMatcher.compile(p) for p in patterns]) for bit, patterns in relations]
+        self.masks = {}
+    def __repr__(self):
+        return "DE-9IM relation matcher: %d relations, %d matrices seen" % (len(self.relations), len(self.masks))
+
+    # (negated, alternatives), every alternative holding the sets of allowed values of the 9 cells
+    def compile(p):
+        if isinstance(p, AntiPattern):
+            return True, [tuple(DIMS[c] for c in p.anti_pattern)]
+        if isinstance(p, NOrPattern):
+            return False, [tuple(DIMS[c] for c in s) for s in p.patterns]
+        return False, [tuple(DIMS[c] for c in p.pattern)]
+
+    def evaluate(self, matrix_string):
+        matrix = matrix_string.upper()
+        mask = 0
+        for bit, patterns in self.relations:
+            for negated, alternatives in patterns:
+                if negated != any(all(m in dims for m, dims in zip(matrix, alternative)) for alternative in alternatives):
+                    mask |= bit
+                    break
+        return mask
+
+    # bitmask of the relations a matrix string satisfies; real datasets produce only
+    # a few dozen distinct matrices, so nearly every call is a dictionary lookup
+    def getMask(self, matrix_string):
+        mask = self.masks.get(matrix_string)
+        if mask is None:
+            mask = self.masks[matrix_string] = self.evaluate(matrix_string)
+        return mask
+
+relation_matcher = RelationMatcher([
+    (INTERSECTS, [intersects]),
+    (WITHIN, [within]),
+    (COVERED_BY, [covered_by]),
+    (CROSSES, [crosses_lines, crosses_1, crosses_2]),
+    (OVERLAPS, [overlaps1, overlaps2]),
+    (EQUALS, [equal]),
+    (TOUCHES, [touches]),
+    (CONTAINS, [contains]),
+    (COVERS, [covers]),
+    ])
+
+# stands in for the matrix of a pair known to be disjoint, which satisfies none of the relations
+disjoint_matrix = 'FFFFFFFF2'
+
+# Matrices of a polygon or multipolygon with geometries in its interior: the boundary and exterior
+# of the polygon lie in their exterior, so only the dimensions of their interior and of their
+# boundary, 'F' when empty, vary. Not for geometry collections, which have no boundary.
+def contained_matrices(geometries):
+    boundaries = shapely.boundary(geometries)
+    boundary_dims = np.where(shapely.is_empty(boundaries), -1, shapely.get_dimensions(boundaries))
+    return np.array(['%d%s2FF1FF2' % (dim, 'F' if boundary_dim < 0 else boundary_dim)
+                     for dim, boundary_dim in zip(shapely.get_dimensions(geometries), boundary_dims)], dtype=object)
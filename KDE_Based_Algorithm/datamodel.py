@@ -1,7 +1,21 @@
-from shapely import relate
-from de9im_patterns import contains, crosses_lines, crosses_1, crosses_2, disjoint, equal, intersects, overlaps1, overlaps2, touches, within, covered_by, covers
+import numpy as np
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full, Queue
+from shapely import contains_properly, geos_version, get_type_id, intersects, relate
+from geometrystore import PreparedGeometryCache
+from de9im_patterns import relation_matcher, disjoint_matrix, contained_matrices, INTERSECTS, WITHIN, COVERED_BY, CROSSES, OVERLAPS, EQUALS, TOUCHES, CONTAINS, COVERS
+
+# raised in the verifying thread once the consumer of iterLinks has stopped
+class VerificationCancelled(Exception):
+    pass
 
 class RelatedGeometries :
+        # the relate of GEOS 3.13 on finds the matrix of a contained target about as fast as
+        # contains_properly does, so the shortcut for those pays off only before it
+        CONTAINED_SHORTCUT = geos_version < (3, 13, 0)
+
         def __init__(self, qualifyingPairs) :
             self.pgr = 0
             self.exceptions = 0
@@ -29,6 +43,14 @@ class RelatedGeometries :
             self.touchesD2 = []
             self.withinD1 = []
             self.withinD2 = []
+            self.preparedSources = PreparedGeometryCache()
+            self.noOfThreads = 1
+            self.executor = None
+            self.pendingBatches = deque()
+            # called with the (source ids, target ids, relation masks) of the pairs, as they are recorded
+            self.listener = None
+            # set once the consumer of iterLinks has stopped
+            self.cancelled = None
 
         def addContains(self, gId1,  gId2) :
           self.containsD1.append(gId1)
@@ -109,6 +131,7 @@ class RelatedGeometries :
             else:
               print('array is empty 3')
             print("Verified pairs", str(self.verifiedPairs))
+            print("Prepared geometry cache hits", str(self.preparedSources.hits), "misses", str(self.preparedSources.misses))
 
         def Precision_Threshold(self, ConditionLimit):
           if self.verifiedPairs != 0:
@@ -129,43 +152,47 @@ class RelatedGeometries :
 
 
         def  verifyRelations(self, geomId1,  geomId2,  sourceGeom,  targetGeom, heuristicCondition, ConditionLimit,violation_limit) :
+            return self.addRelations(geomId1, geomId2, self.getMatrix(geomId1, sourceGeom, targetGeom), heuristicCondition, ConditionLimit, violation_limit)
+
+        # records a verified pair from its DE-9IM matrix, wherever that was computed
+        def  addRelations(self, geomId1,  geomId2,  array, heuristicCondition, ConditionLimit,violation_limit) :
             related = False
             self.verifiedPairs += 1
-            array = relate(sourceGeom, targetGeom)
 
-            if intersects.matches(array):
+            mask = relation_matcher.getMask(array)
+            if mask & INTERSECTS:
                 related = True
                 self.detectedLinks += 1
                 self.addIntersects(geomId1, geomId2)
-            if within.matches(array):
+            if mask & WITHIN:
                 related = True
                 self.detectedLinks += 1
                 self.addWithin(geomId1, geomId2)
-            if covered_by.matches(array):
+            if mask & COVERED_BY:
                 related = True
                 self.detectedLinks += 1
                 self.addCoveredBy(geomId1, geomId2)
-            if crosses_lines.matches(array) or crosses_1.matches(array) or crosses_2.matches(array):
+            if mask & CROSSES:
                 related = True
                 self.detectedLinks += 1
                 self.addCrosses(geomId1, geomId2)
-            if overlaps1.matches(array) or overlaps2.matches(array):
+            if mask & OVERLAPS:
                 related = True
                 self.detectedLinks += 1
                 self.addOverlaps(geomId1, geomId2)
-            if  equal.matches(array):
+            if mask & EQUALS:
                 related = True
                 self.detectedLinks += 1
                 self.addEquals(geomId1, geomId2)
-            if  touches.matches(array):
+            if mask & TOUCHES:
                 related = True
                 self.detectedLinks += 1
                 self.addTouches(geomId1, geomId2)
-            if  contains.matches(array):
+            if mask & CONTAINS:
                 related = True
                 self.detectedLinks += 1
                 self.addContains(geomId1, geomId2)
-            if covers.matches(array):
+            if mask & COVERS:
                 related = True
                 self.detectedLinks += 1
                 self.addCovers(geomId1, geomId2)
@@ -176,6 +203,8 @@ class RelatedGeometries :
                 self.continuous_unrelated_Pairs = 0
             else:
                 self.continuous_unrelated_Pairs += 1
+            if self.listener is not None:
+                self.listener([int(geomId1)], [int(geomId2)], [mask])
 
             if violation_limit == 0:
               if heuristicCondition == "Precision_Threshold":
@@ -211,3 +240,175 @@ class RelatedGeometries :
                         return 2
 
             return related
+
+        # Verifies whole arrays of pairs with one vectorized relate call; counters and link lists
+        # end up as if the pairs had been verified one by one, in order. Returns which are related;
+        # no heuristic condition is checked, as with verifyRelations(..., None, None, 0).
+        def  verifyRelationsBatch(self, geomIds1,  geomIds2,  sourceGeoms,  targetGeoms) :
+            return self.addRelationsBatch(geomIds1, geomIds2, self.getMatrices(geomIds1, sourceGeoms, targetGeoms))
+
+        # The DE-9IM matrix of a pair. Sources that take part in many pairs get prepared and cached by
+        # id, and for those the prepared predicates are cheaper than relate.
+        def  getMatrix(self, geomId1,  sourceGeom,  targetGeom) :
+            if not self.preparedSources.get(geomId1, sourceGeom):
+                return relate(sourceGeom, targetGeom)
+            return self.getPreparedMatrices(np.array([sourceGeom]), np.array([targetGeom]))[0]
+
+        def  getMatrices(self, geomIds1,  sourceGeoms,  targetGeoms) :
+            sourceGeoms = np.asarray(sourceGeoms, dtype=object)
+            targetGeoms = np.asarray(targetGeoms, dtype=object)
+            prepared = self.preparedSources.getMany(geomIds1, sourceGeoms)
+            matrices = np.empty(len(sourceGeoms), dtype=object)
+            matrices[~prepared] = relate(sourceGeoms[~prepared], targetGeoms[~prepared])
+            matrices[prepared] = self.getPreparedMatrices(sourceGeoms[prepared], targetGeoms[prepared])
+            return matrices
+
+        # A disjoint pair satisfies none of the relations, and a target in the interior of a polygonal
+        # source has a matrix given by its own dimensions, so relate runs only for the pairs left.
+        def  getPreparedMatrices(self, sourceGeoms,  targetGeoms) :
+            matrices = np.full(len(sourceGeoms), disjoint_matrix, dtype=object)
+            related = intersects(sourceGeoms, targetGeoms)
+            # polygons and multipolygons holding anything but geometry collections
+            contained = related & np.isin(get_type_id(sourceGeoms), (3, 6)) & (get_type_id(targetGeoms) != 7) & self.CONTAINED_SHORTCUT
+            contained[contained] = contains_properly(sourceGeoms[contained], targetGeoms[contained])
+            matrices[contained] = contained_matrices(targetGeoms[contained])
+            related &= ~contained
+            matrices[related] = relate(sourceGeoms[related], targetGeoms[related])
+            return matrices
+
+        # Vectorized relate releases the GIL, so with more than one thread the batches given to
+        # submitRelationsBatch are split in one slice per thread and related by a thread pool, while
+        # the caller goes on gathering pairs. Finished batches are recorded by the caller's thread
+        # alone, in submission order, so counters and link lists are those of a serial run; flush
+        # waits for the rest. Prepared geometries are not thread-safe, so the threads skip the cache.
+        def  setThreads(self, noOfThreads) :
+            self.flush()
+            self.shutdown()
+            self.noOfThreads = noOfThreads
+
+        def  submitRelationsBatch(self, geomIds1,  geomIds2,  sourceGeoms,  targetGeoms) :
+            if self.noOfThreads <= 1:
+                self.verifyRelationsBatch(geomIds1, geomIds2, sourceGeoms, targetGeoms)
+                return
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.noOfThreads)
+            sourceGeoms = np.asarray(sourceGeoms, dtype=object)
+            targetGeoms = np.asarray(targetGeoms, dtype=object)
+            bounds = np.linspace(0, len(sourceGeoms), self.noOfThreads + 1).astype(np.int64).tolist()
+            futures = [self.executor.submit(relate, sourceGeoms[start:end], targetGeoms[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+            self.pendingBatches.append((geomIds1, geomIds2, futures))
+            # at most two batches per thread in flight
+            while self.pendingBatches and (2 * self.noOfThreads < len(self.pendingBatches) or all(future.done() for future in self.pendingBatches[0][2])):
+                self.addPendingBatch()
+
+        def  flush(self) :
+            while self.pendingBatches:
+                self.addPendingBatch()
+
+        def  addPendingBatch(self) :
+            geomIds1, geomIds2, futures = self.pendingBatches.popleft()
+            self.addRelationsBatch(geomIds1, geomIds2, np.concatenate([future.result() for future in futures]))
+
+        # Stops the threads once verification is over, after a flush, or when it fails or is
+        # cancelled, in which case the batches not recorded yet are dropped. The next submitted
+        # batch starts them again.
+        def  shutdown(self) :
+            self.pendingBatches.clear()
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures = True)
+                self.executor = None
+
+        # Runs run, such as the applyProcessing of an algorithm, in a thread and yields the
+        # (source id, target id, relation mask) of every related pair as soon as it is recorded, in
+        # order; the masks hold the de9im_patterns bits. Up to bufferSize groups of links wait for
+        # the consumer before verification blocks, and closing the generator stops the run at the
+        # next verified pair. Errors of the run are raised to the consumer.
+        def  iterLinks(self, run, bufferSize = 64) :
+            links = Queue(bufferSize)
+            cancelled = threading.Event()
+
+            def put(item):
+                while not cancelled.is_set():
+                    try:
+                        links.put(item, timeout = 0.1)
+                        return
+                    except Full:
+                        pass
+                raise VerificationCancelled()
+
+            def listen(geomIds1, geomIds2, masks):
+                related = [link for link in zip(geomIds1, geomIds2, masks) if link[2]]
+                if related:
+                    put(related)
+                elif cancelled.is_set():
+                    raise VerificationCancelled()
+
+            def verify():
+                outcome = None
+                try:
+                    run()
+                except VerificationCancelled:
+                    return
+                except BaseException as exception:
+                    outcome = exception
+                try:
+                    put(outcome)
+                except VerificationCancelled:
+                    pass
+
+            self.listener = listen
+            self.cancelled = cancelled
+            worker = threading.Thread(target = verify, daemon = True)
+            worker.start()
+            try:
+                while True:
+                    related = links.get()
+                    if related is None:
+                        return
+                    if isinstance(related, BaseException):
+                        raise related
+                    yield from related
+            finally:
+                cancelled.set()
+                worker.join()
+                self.listener = None
+                self.cancelled = None
+
+        # called by the run between chunks of work that records no pairs, such as filtering and
+        # weighting, so that closing iterLinks stops it before verification as well
+        def  checkCancelled(self) :
+            if self.cancelled is not None and self.cancelled.is_set():
+                raise VerificationCancelled()
+
+        def  addRelationsBatch(self, geomIds1,  geomIds2,  arrays) :
+            arrays = np.asarray(arrays, dtype=object)
+            if len(arrays) == 0:
+                return np.zeros(0, dtype=bool)
+            # one matcher lookup per distinct matrix
+            matrices, inverse = np.unique(arrays, return_inverse=True)
+            masks = np.array([relation_matcher.getMask(array) for array in matrices.tolist()], dtype=np.int64)[inverse.ravel()]
+            geomIds1, geomIds2 = np.asarray(geomIds1, dtype=np.int64), np.asarray(geomIds2, dtype=np.int64)
+            self.verifiedPairs += len(masks)
+
+            for bit, links1, links2 in ((INTERSECTS, self.intersectsD1, self.intersectsD2), (WITHIN, self.withinD1, self.withinD2),
+                                        (COVERED_BY, self.coveredByD1, self.coveredByD2), (CROSSES, self.crossesD1, self.crossesD2),
+                                        (OVERLAPS, self.overlapsD1, self.overlapsD2), (EQUALS, self.equalsD1, self.equalsD2),
+                                        (TOUCHES, self.touchesD1, self.touchesD2), (CONTAINS, self.containsD1, self.containsD2),
+                                        (COVERS, self.coversD1, self.coversD2)):
+                selected = (masks & bit) != 0
+                links1.extend(geomIds1[selected].tolist())
+                links2.extend(geomIds2[selected].tolist())
+                self.detectedLinks += int(np.count_nonzero(selected))
+
+            related = masks != 0
+            relatedPositions = np.flatnonzero(related)
+            interlinked = self.interlinkedGeometries + np.arange(1, len(relatedPositions) + 1)
+            self.pgr += int(interlinked.sum())
+            self.interlinkedGeometries += len(relatedPositions)
+            if len(relatedPositions):
+                self.continuous_unrelated_Pairs = len(masks) - 1 - int(relatedPositions[-1])
+            else:
+                self.continuous_unrelated_Pairs += len(masks)
+            if self.listener is not None:
+                self.listener(geomIds1.tolist(), geomIds2.tolist(), masks.tolist())
+            return related
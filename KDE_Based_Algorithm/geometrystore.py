@@ -0,0 +1,235 @@
+import json
+import os
+import shutil
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import shapely
+
+# On-disk layout: MAGIC | version (uint32) | header length (uint32) | JSON header | padding |
+# bounds (float64, n x 4) | WKB offsets (int64, n + 1) | WKB bytes.
+# Every array starts on an 8-byte boundary so it can be memory-mapped in place.
+class WKBStore:
+    MAGIC = b'GIANTWKB'
+    VERSION = 1
+
+    def __init__(self, path, metadata, bounds, offsets, wkb):
+        self.path = path
+        self.metadata = metadata
+        self.bounds = bounds
+        self.offsets = offsets
+        self.wkb = wkb
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def getWKB(self, geometryId):
+        return self.wkb[self.offsets[geometryId]:self.offsets[geometryId + 1]].tobytes()
+
+    def decode(self, geometryIds = None):
+        if geometryIds is None:
+            starts, ends = self.offsets[:-1].tolist(), self.offsets[1:].tolist()
+        else:
+            geometryIds = np.asarray(geometryIds, dtype=np.int64)
+            starts, ends = self.offsets[geometryIds].tolist(), self.offsets[geometryIds + 1].tolist()
+        buffer = memoryview(self.wkb)
+        wkbs = np.empty(len(starts), dtype=object)
+        # an empty slot holds no WKB and decodes to None
+        wkbs[:] = [buffer[start:end].tobytes() or None for start, end in zip(starts, ends)]
+        return shapely.from_wkb(wkbs)
+
+    def align(position):
+        return (position + 7) & ~7
+
+    def write(path, geometries, bounds, metadata):
+        WKBStore.writeChunks(path, [(shapely.to_wkb(geometries), bounds)], metadata)
+
+    # chunks yields (WKB, bounds) pairs, so that inputs that already hold WKB are copied as they
+    # are; the WKB is spooled to a side file so that only the bounds and offsets are held in
+    # memory, and metadata is serialised after the last chunk
+    def writeChunks(path, chunks, metadata):
+        temporaryPath = path + '.%d.tmp' % os.getpid()
+        spoolPath = temporaryPath + '.wkb'
+        boundParts, lengthParts = [], []
+        try:
+            with open(spoolPath, 'wb') as spool:
+                for wkbs, bounds in chunks:
+                    lengthParts.append(np.fromiter(map(len, wkbs), dtype=np.int64, count=len(wkbs)))
+                    boundParts.append(np.asarray(bounds, dtype=np.float64).reshape(-1, 4))
+                    spool.write(b''.join(wkbs))
+
+            count = sum(len(lengths) for lengths in lengthParts)
+            offsets = np.zeros(count + 1, dtype=np.int64)
+            if count:
+                np.cumsum(np.concatenate(lengthParts), out=offsets[1:])
+
+            headerBytes = json.dumps({'count': count, 'metadata': metadata}).encode()
+            boundsOffset = WKBStore.align(len(WKBStore.MAGIC) + 8 + len(headerBytes))
+            with open(temporaryPath, 'wb') as f:
+                f.write(WKBStore.MAGIC)
+                f.write(np.array([WKBStore.VERSION, len(headerBytes)], dtype=np.uint32).tobytes())
+                f.write(headerBytes)
+                f.write(b'\0' * (boundsOffset - f.tell()))
+                for bounds in boundParts:
+                    f.write(bounds.tobytes())
+                f.write(offsets.tobytes())
+                with open(spoolPath, 'rb') as spool:
+                    shutil.copyfileobj(spool, f, 1 << 24)
+            # rename into place, so readers never see a partial store
+            os.replace(temporaryPath, path)
+        finally:
+            for leftover in (spoolPath, temporaryPath):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    def open(path):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            prefix = f.read(len(WKBStore.MAGIC) + 8)
+            if len(prefix) < len(WKBStore.MAGIC) + 8 or prefix[:len(WKBStore.MAGIC)] != WKBStore.MAGIC:
+                return None
+            version, headerLength = np.frombuffer(prefix[len(WKBStore.MAGIC):], dtype=np.uint32)
+            if version != WKBStore.VERSION:
+                return None
+            header = json.loads(f.read(int(headerLength)))
+
+        count = header['count']
+        boundsOffset = WKBStore.align(len(WKBStore.MAGIC) + 8 + int(headerLength))
+        offsetsOffset = boundsOffset + count * 4 * 8
+        wkbOffset = offsetsOffset + (count + 1) * 8
+        fileSize = os.path.getsize(path)
+        if fileSize < wkbOffset:
+            return None
+
+        offsets = np.memmap(path, dtype=np.int64, mode='r', offset=offsetsOffset, shape=(count + 1,))
+        if fileSize != wkbOffset + int(offsets[-1]):
+            return None
+        bounds = np.memmap(path, dtype=np.float64, mode='r', offset=boundsOffset, shape=(count, 4)) if count else np.empty((0, 4))
+        if offsets[-1] == 0:
+            wkb = np.empty(0, dtype=np.uint8)
+        else:
+            wkb = np.memmap(path, dtype=np.uint8, mode='r', offset=wkbOffset, shape=(int(offsets[-1]),))
+        return WKBStore(path, header['metadata'], bounds, offsets, wkb)
+
+# The WKBStore arrays in a multiprocessing.shared_memory segment instead of a file:
+# bounds (float64, n x 4) | WKB offsets (int64, n + 1) | WKB bytes. Pickling the store sends only
+# the segment name, so worker processes attach to the same pages without copying them and decode
+# just the geometries they use. The creating process owns the segment and unlinks it on close();
+# in a worker, close() only detaches.
+class SharedWKBStore(WKBStore):
+    def __init__(self, segment, count, owner):
+        self.segment = segment
+        self.count = count
+        self.owner = owner
+        offsets = np.ndarray((count + 1,), dtype=np.int64, buffer=segment.buf, offset=count * 32)
+        wkb = np.ndarray((int(offsets[-1]),), dtype=np.uint8, buffer=segment.buf, offset=count * 32 + (count + 1) * 8)
+        WKBStore.__init__(self, None, {}, np.ndarray((count, 4), dtype=np.float64, buffer=segment.buf), offsets, wkb)
+
+    # None geometries are kept as empty slots
+    def create(geometries, bounds = None):
+        geometries = np.asarray(geometries, dtype=object)
+        wkbs = shapely.to_wkb(geometries)
+        lengths = np.fromiter((0 if wkb is None else len(wkb) for wkb in wkbs), dtype=np.int64, count=len(wkbs))
+        offsets = np.zeros(len(wkbs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        count = len(wkbs)
+        segment = shared_memory.SharedMemory(create=True, size=max(count * 32 + (count + 1) * 8 + int(offsets[-1]), 1))
+        try:
+            segment.buf[count * 32:count * 40 + 8] = offsets.tobytes()
+            store = SharedWKBStore(segment, count, True)
+        except BaseException:
+            segment.close()
+            segment.unlink()
+            raise
+        store.bounds[:] = shapely.bounds(geometries) if bounds is None else np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        store.wkb[:] = np.frombuffer(b''.join(wkb for wkb in wkbs if wkb is not None), dtype=np.uint8)
+        return store
+
+    def __getstate__(self):
+        return self.segment.name, self.count
+
+    def __setstate__(self, state):
+        name, count = state
+        self.__init__(shared_memory.SharedMemory(name=name), count, False)
+
+    def close(self):
+        if self.segment is None:
+            return
+        # the views must go before the segment can be closed
+        self.bounds = self.offsets = self.wkb = None
+        self.segment.close()
+        if self.owner:
+            self.segment.unlink()
+        self.segment = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+# LRU cache of prepared geometries by id, bounded by their total number of coordinates, which is
+# what GEOS holds on to. Preparing only pays off for large geometries that take part in many pairs,
+# as every prepared predicate builds its own index on first use, so a geometry is prepared on its
+# PREPARE_AFTER-th use and smaller ones never are. Geometries are prepared in place, so an entry
+# is a hit only while the caller passes the same object.
+class PreparedGeometryCache:
+    MIN_COORDINATES = 256
+    MAX_COORDINATES = 1 << 22
+    PREPARE_AFTER = 8
+
+    def __init__(self, minCoordinates = MIN_COORDINATES, maxCoordinates = MAX_COORDINATES, prepareAfter = PREPARE_AFTER):
+        self.minCoordinates = minCoordinates
+        self.maxCoordinates = maxCoordinates
+        self.prepareAfter = prepareAfter
+        self.entries = OrderedDict()
+        # uses of the ids not prepared yet, least recently used first, for as many ids as the cache
+        # could hold prepared
+        self.uses = OrderedDict()
+        self.maxTracked = max(maxCoordinates // max(minCoordinates, 1), 1)
+        self.noOfCoordinates = 0
+        self.hits = 0
+        self.misses = 0
+
+    # whether the geometry is prepared, after this use
+    def get(self, geometryId, geometry, coordinates = None):
+        if coordinates is None:
+            coordinates = int(shapely.get_num_coordinates(geometry))
+        if not self.minCoordinates <= coordinates <= self.maxCoordinates:
+            return False
+        entry = self.entries.get(geometryId)
+        if entry is not None:
+            if entry[0] is geometry:
+                self.entries.move_to_end(geometryId)
+                self.hits += 1
+                return True
+            self.evict(geometryId)
+        self.misses += 1
+        uses = self.uses.pop(geometryId, 0) + 1
+        if uses < self.prepareAfter:
+            self.uses[geometryId] = uses
+            if self.maxTracked < len(self.uses):
+                self.uses.popitem(last=False)
+            return False
+        shapely.prepare(geometry)
+        self.entries[geometryId] = (geometry, coordinates)
+        self.noOfCoordinates += coordinates
+        while self.maxCoordinates < self.noOfCoordinates:
+            self.evict(next(iter(self.entries)))
+        return True
+
+    # same for arrays of geometries, in order
+    def getMany(self, geometryIds, geometries):
+        geometries = np.asarray(geometries, dtype=object)
+        coordinates = shapely.get_num_coordinates(geometries)
+        prepared = np.zeros(len(geometries), dtype=bool)
+        cacheable = np.flatnonzero((self.minCoordinates <= coordinates) & (coordinates <= self.maxCoordinates))
+        for position, geometryId, count in zip(cacheable.tolist(), np.asarray(geometryIds)[cacheable].tolist(), coordinates[cacheable].tolist()):
+            prepared[position] = self.get(geometryId, geometries[position], count)
+        return prepared
+
+    def evict(self, geometryId):
+        geometry, coordinates = self.entries.pop(geometryId)
+        self.noOfCoordinates -= coordinates
+        shapely.destroy_prepared(geometry)
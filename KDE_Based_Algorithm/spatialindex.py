@@ -0,0 +1,440 @@
+import json
+import os
+import numpy as np
+import shapely
+
+# concatenation of arange(start, start + count) for every start/count pair, without a Python loop
+def expandRanges(starts, counts):
+    counts = np.asarray(counts, dtype=np.int64)
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.cumsum(counts)
+    positions = np.arange(total, dtype=np.int64) - np.repeat(ends - counts, counts)
+    return np.repeat(np.asarray(starts, dtype=np.int64), counts) + positions
+
+# Number of cells shared by pairs of [minX, maxX) x [minY, maxY) cell ranges, i.e. the cells an
+# equigrid would report both geometries of a pair in.
+def countCommonCells(ranges1, ranges2):
+    minX1, minY1, maxX1, maxY1 = ranges1
+    minX2, minY2, maxX2, maxY2 = ranges2
+    columns = np.minimum(maxX1, maxX2) - np.maximum(minX1, minX2)
+    rows = np.minimum(maxY1, maxY2) - np.maximum(minY1, minY2)
+    return np.maximum(columns, 0) * np.maximum(rows, 0)
+
+# Equigrid whose non-empty cells are stored in CSR layout: cellKeys holds the sorted linearised
+# keys of the occupied cells, and the ids of cell i are cellIds[cellOffsets[i]:cellOffsets[i + 1]],
+# in increasing order. upperInclusive selects whether a geometry spans the cells up to and
+# including ceil(maxX / thetaX) (the ML algorithms) or stops just before it (ProgressiveGIAnt).
+# With referencePoint, a pair is reported only from the cell that holds the lower-left corner of
+# the intersection of its two cell ranges, instead of being deduplicated by sorting. The ids of a
+# cell are then grouped by whether the cell is in the first column and/or first row of their
+# range (both, first row only, first column only, neither); groupOffsets holds where the last
+# three groups start, so a lookup reads only the ids that can own a pair in that cell.
+class EquiGrid:
+    MAGIC = b'GIANTIDX'
+    VERSION = 1
+    # share of changed geometries above which update rebuilds the grid instead of using an overlay
+    COMPACTION_RATIO = 0.1
+
+    def __init__(self, thetaX, thetaY, upperInclusive = True, referencePoint = False):
+        self.thetaX = thetaX
+        self.thetaY = thetaY
+        self.upperInclusive = upperInclusive
+        self.referencePoint = referencePoint
+        self.sourceRanges = np.empty((0, 4), dtype=np.int64)
+        self.groupOffsets = np.empty((0, 3), dtype=np.int64)
+        self.minCellX, self.minCellY = 0, 0
+        self.noOfColumns, self.noOfRows = 0, 0
+        self.cellKeys = np.empty(0, dtype=np.int64)
+        self.cellOffsets = np.zeros(1, dtype=np.int64)
+        self.cellIds = np.empty(0, dtype=np.int32)
+        self.noOfGeometries = 0
+        self.changed = None
+        self.overlay = None
+        self.overlayIds = None
+
+    # cell index ranges [minX, maxX) x [minY, maxY) of every row of an (n, 4) bounds array;
+    # geometries with undefined (empty) bounds get an empty range
+    def getCellRanges(self, bounds):
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        valid = ~np.isnan(bounds).any(axis=1)
+        bounds = np.where(valid[:, None], bounds, 0)
+        extra = 1 if self.upperInclusive else 0
+        minX = np.floor(bounds[:, 0] / self.thetaX).astype(np.int64)
+        minY = np.floor(bounds[:, 1] / self.thetaY).astype(np.int64)
+        maxX = np.where(valid, np.ceil(bounds[:, 2] / self.thetaX).astype(np.int64) + extra, minX)
+        maxY = np.where(valid, np.ceil(bounds[:, 3] / self.thetaY).astype(np.int64) + extra, minY)
+        return minX, minY, np.maximum(maxX, minX), np.maximum(maxY, minY)
+
+    def build(self, bounds):
+        minX, minY, maxX, maxY = self.getCellRanges(bounds)
+        self.noOfGeometries = len(minX)
+        self.changed = self.overlay = self.overlayIds = None
+        if self.referencePoint:
+            self.sourceRanges = np.stack((minX, minY, maxX, maxY), axis=1)
+        occupied = (minX < maxX) & (minY < maxY)
+        if not occupied.any():
+            return self
+
+        self.minCellX, self.minCellY = int(minX[occupied].min()), int(minY[occupied].min())
+        self.noOfColumns = int(maxX[occupied].max()) - self.minCellX
+        self.noOfRows = int(maxY[occupied].max()) - self.minCellY
+
+        # one (key, id) entry per covered cell; a stable sort keeps the ids of every cell ascending
+        widths, heights = maxX - minX, maxY - minY
+        counts = widths * heights
+        ids = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+        local = expandRanges(np.zeros(len(counts)), counts)
+        repeatedHeights = np.repeat(heights, counts)
+        cellX = np.repeat(minX - self.minCellX, counts) + local // repeatedHeights
+        cellY = np.repeat(minY - self.minCellY, counts) + local % repeatedHeights
+        keys = cellX * self.noOfRows + cellY
+
+        if self.referencePoint:
+            groups = 3 - ((local < repeatedHeights).astype(np.int64) + 2 * (local % repeatedHeights == 0))
+            order = np.argsort(keys * 4 + groups, kind='stable')
+        else:
+            order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        self.cellIds = ids[order]
+        starts = np.flatnonzero(np.diff(keys)) + 1
+        self.cellKeys = keys[np.insert(starts, 0, 0)]
+        self.cellOffsets = np.concatenate(([0], starts, [len(keys)])).astype(np.int64)
+        if self.referencePoint:
+            cells = np.repeat(np.arange(len(self.cellKeys)), np.diff(self.cellOffsets))
+            groupSizes = np.bincount(cells * 4 + groups[order], minlength=4 * len(self.cellKeys)).reshape(-1, 4)
+            self.groupOffsets = self.cellOffsets[:-1, None] + np.cumsum(groupSizes, axis=1)[:, :3]
+        return self
+
+    # ids of the cell at column cellX and row cellY, as a view into cellIds
+    def getCell(self, cellX, cellY):
+        cellX -= self.minCellX
+        cellY -= self.minCellY
+        if not (0 <= cellX < self.noOfColumns and 0 <= cellY < self.noOfRows):
+            return self.cellIds[:0]
+        key = cellX * self.noOfRows + cellY
+        position = np.searchsorted(self.cellKeys, key)
+        if position == len(self.cellKeys) or self.cellKeys[position] != key:
+            return self.cellIds[:0]
+        return self.cellIds[self.cellOffsets[position]:self.cellOffsets[position + 1]]
+
+    # positions in cellKeys of linearised cell keys, and which of the keys belong to occupied cells
+    def findCells(self, keys):
+        if len(self.cellKeys) == 0:
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.cellKeys, keys), len(self.cellKeys) - 1)
+        return positions, self.cellKeys[positions] == keys
+
+    # non-empty cells covered by the envelope, column by column; cells outside the grid are skipped
+    def getCells(self, envelope):
+        minX, minY, maxX, maxY = (int(v[0]) for v in self.getCellRanges(envelope))
+        columns = np.arange(max(minX, self.minCellX), min(maxX, self.minCellX + self.noOfColumns)) - self.minCellX
+        rows = np.arange(max(minY, self.minCellY), min(maxY, self.minCellY + self.noOfRows)) - self.minCellY
+        positions, occupied = self.findCells((columns[:, None] * self.noOfRows + rows[None, :]).ravel())
+        positions = positions[occupied]
+        for start, end in zip(self.cellOffsets[positions].tolist(), self.cellOffsets[positions + 1].tolist()):
+            yield self.cellIds[start:end]
+
+    # All (source, target) pairs that share at least one cell, for a block of targets whose ids
+    # start at firstTargetId. Pairs come out sorted by target and then source id, together with
+    # the number of cells they share; everything is computed with sorting and grouping. In
+    # referencePoint mode, the pairs of a target follow its cells instead of the source ids.
+    def getCandidatePairs(self, targetBounds, firstTargetId = 0):
+        sourceIds, targetIds, commonBlocks = self.getCellPairs(targetBounds)
+        if self.overlay is not None:
+            # geometries changed since the last build are answered by the overlay alone
+            current = ~self.changed[sourceIds]
+            overlaySources, overlayTargets, overlayBlocks = self.overlay.getCellPairs(targetBounds)
+            sourceIds = np.concatenate((sourceIds[current], self.overlayIds[overlaySources]))
+            targetIds = np.concatenate((targetIds[current], overlayTargets))
+            commonBlocks = np.concatenate((commonBlocks[current], overlayBlocks))
+            order = np.lexsort((sourceIds, targetIds))
+            sourceIds, targetIds, commonBlocks = sourceIds[order], targetIds[order], commonBlocks[order]
+        return sourceIds, targetIds + firstTargetId, commonBlocks
+
+    def getCellPairs(self, targetBounds):
+        targetRanges = self.getCellRanges(targetBounds)
+        minX, minY, maxX, maxY = targetRanges
+        minX, maxX = np.maximum(minX, self.minCellX), np.minimum(maxX, self.minCellX + self.noOfColumns)
+        minY, maxY = np.maximum(minY, self.minCellY), np.minimum(maxY, self.minCellY + self.noOfRows)
+        heights = np.maximum(maxY - minY, 0)
+        counts = np.maximum(maxX - minX, 0) * heights
+
+        targets = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+        local = expandRanges(np.zeros(len(counts)), counts)
+        repeatedHeights = np.repeat(heights, counts)
+        cellX = np.repeat(minX - self.minCellX, counts) + local // repeatedHeights
+        cellY = np.repeat(minY - self.minCellY, counts) + local % repeatedHeights
+        positions, occupied = self.findCells(cellX * self.noOfRows + cellY)
+        targets, positions = targets[occupied], positions[occupied]
+
+        if self.referencePoint:
+            return self.getReferencePairs(positions, targets, cellX[occupied], cellY[occupied], targetRanges)
+        sizes = self.cellOffsets[positions + 1] - self.cellOffsets[positions]
+        sources = self.cellIds[expandRanges(self.cellOffsets[positions], sizes)].astype(np.int64)
+        pairKeys, commonBlocks = np.unique(np.repeat(targets, sizes) * self.noOfGeometries + sources, return_counts=True)
+        if self.noOfGeometries == 0:
+            return pairKeys, pairKeys, commonBlocks
+        return pairKeys % self.noOfGeometries, pairKeys // self.noOfGeometries, commonBlocks
+
+    # For every (target, cell) lookup, the ids whose pair with the target has its reference cell
+    # there: all of them in the target's lower-left cell, otherwise only those for which the cell
+    # is in the first row (target's first column), first column (target's first row) or both.
+    def getReferencePairs(self, positions, targets, cellX, cellY, targetRanges):
+        firstColumn = cellX == targetRanges[0][targets] - self.minCellX
+        firstRow = cellY == targetRanges[1][targets] - self.minCellY
+        starts, ends = self.cellOffsets[positions], self.cellOffsets[positions + 1]
+        groupOffsets = self.groupOffsets[positions]
+        firstEnds = np.where(firstColumn & firstRow, ends, np.where(firstColumn, groupOffsets[:, 1], groupOffsets[:, 0]))
+        secondStarts = groupOffsets[:, 1]
+        secondSizes = np.where(firstRow & ~firstColumn, groupOffsets[:, 2] - secondStarts, 0)
+
+        rangeStarts = np.stack((starts, secondStarts), axis=1).ravel()
+        rangeSizes = np.stack((firstEnds - starts, secondSizes), axis=1).ravel()
+        sources = self.cellIds[expandRanges(rangeStarts, rangeSizes)].astype(np.int64)
+        targets = np.repeat(np.repeat(targets, 2), rangeSizes)
+        commonBlocks = countCommonCells(self.sourceRanges[sources].T, [r[targets] for r in targetRanges])
+        return sources, targets, commonBlocks
+
+    # cells spanned by each envelope counted over the closed range of cell indices,
+    # as getNoOfBlocks does in every algorithm
+    def getNoOfBlocks(self, bounds):
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        columns = np.ceil(bounds[:, 2] / self.thetaX) - np.floor(bounds[:, 0] / self.thetaX) + 1
+        rows = np.ceil(bounds[:, 3] / self.thetaY) - np.floor(bounds[:, 1] / self.thetaY) + 1
+        return (columns * rows).astype(np.int64)
+
+    def getNoOfEntries(self):
+        return len(self.cellIds) + (0 if self.overlay is None else self.overlay.getNoOfEntries())
+
+    # Applies changes to the geometries in geometryIds, given the current bounds of all geometries:
+    # ids past the end are insertions and NaN bounds are deletions. The changed geometries are
+    # masked out of the cells and indexed in a small overlay grid, until they exceed
+    # COMPACTION_RATIO of the geometries and the whole grid is rebuilt.
+    def update(self, bounds, geometryIds):
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        changed = np.zeros(len(bounds), dtype=bool)
+        if self.changed is not None:
+            changed[:len(self.changed)] = self.changed
+        changed[geometryIds] = True
+        changed[self.noOfGeometries:] = True
+        overlayIds = np.flatnonzero(changed)
+        if self.COMPACTION_RATIO * len(bounds) < len(overlayIds):
+            return self.build(bounds)
+        self.changed, self.overlayIds = changed, overlayIds
+        self.overlay = EquiGrid(self.thetaX, self.thetaY, self.upperInclusive, self.referencePoint).build(bounds[overlayIds])
+        return self
+
+    # On-disk layout: MAGIC | version (uint32) | header length (uint32) | JSON header | padding | arrays.
+    # The header holds the grid parameters, the caller's metadata and the dtype, shape and offset of
+    # every array; the cells are stored along with any per-geometry arrays given in extraArrays.
+    def save(self, path, metadata, extraArrays = {}):
+        if self.overlay is not None:
+            raise ValueError("The grid has pending updates; build it again before saving")
+        arrays = dict(extraArrays, cellKeys=self.cellKeys, cellOffsets=self.cellOffsets, cellIds=self.cellIds)
+        if self.referencePoint:
+            arrays['sourceRanges'], arrays['groupOffsets'] = self.sourceRanges, self.groupOffsets
+        arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+        layout, position = {}, 0
+        for name, array in arrays.items():
+            layout[name] = [array.dtype.str, list(array.shape), position]
+            position = (position + array.nbytes + 7) & ~7
+        header = {'thetaX': self.thetaX, 'thetaY': self.thetaY, 'upperInclusive': self.upperInclusive, 'referencePoint': self.referencePoint,
+                  'minCellX': self.minCellX, 'minCellY': self.minCellY, 'noOfColumns': self.noOfColumns,
+                  'noOfRows': self.noOfRows, 'noOfGeometries': self.noOfGeometries, 'metadata': metadata, 'arrays': layout}
+        headerBytes = json.dumps(header).encode()
+        dataOffset = (len(EquiGrid.MAGIC) + 8 + len(headerBytes) + 7) & ~7
+
+        temporaryPath = path + '.%d.tmp' % os.getpid()
+        try:
+            with open(temporaryPath, 'wb') as f:
+                f.write(EquiGrid.MAGIC)
+                f.write(np.array([EquiGrid.VERSION, len(headerBytes)], dtype=np.uint32).tobytes())
+                f.write(headerBytes)
+                for name, array in arrays.items():
+                    f.write(b'\0' * (dataOffset + layout[name][2] - f.tell()))
+                    f.write(array.tobytes())
+            os.replace(temporaryPath, path)
+        finally:
+            if os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
+
+    # Memory-maps a saved grid, returning (grid, extraArrays), or None when the file is missing, was
+    # written by another version or does not carry the expected metadata. The arrays are read-only
+    # views of the file, so every process that opens the same index shares its pages.
+    def open(path, metadata):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            prefix = f.read(len(EquiGrid.MAGIC) + 8)
+            if len(prefix) < len(EquiGrid.MAGIC) + 8 or prefix[:len(EquiGrid.MAGIC)] != EquiGrid.MAGIC:
+                return None
+            version, headerLength = np.frombuffer(prefix[len(EquiGrid.MAGIC):], dtype=np.uint32)
+            if version != EquiGrid.VERSION:
+                return None
+            header = json.loads(f.read(int(headerLength)))
+        if header['metadata'] != metadata:
+            return None
+
+        dataOffset = (len(EquiGrid.MAGIC) + 8 + int(headerLength) + 7) & ~7
+        fileSize = os.path.getsize(path)
+        arrays = {}
+        for name, (dtype, shape, position) in header['arrays'].items():
+            dtype = np.dtype(dtype)
+            size = int(np.prod(shape)) * dtype.itemsize
+            if fileSize < dataOffset + position + size:
+                return None
+            if size == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=dataOffset + position, shape=tuple(shape))
+
+        grid = EquiGrid(header['thetaX'], header['thetaY'], header['upperInclusive'], header['referencePoint'])
+        if grid.referencePoint:
+            grid.sourceRanges, grid.groupOffsets = arrays.pop('sourceRanges'), arrays.pop('groupOffsets')
+        grid.minCellX, grid.minCellY = header['minCellX'], header['minCellY']
+        grid.noOfColumns, grid.noOfRows = header['noOfColumns'], header['noOfRows']
+        grid.noOfGeometries = header['noOfGeometries']
+        grid.cellKeys, grid.cellOffsets, grid.cellIds = arrays.pop('cellKeys'), arrays.pop('cellOffsets'), arrays.pop('cellIds')
+        return grid, arrays
+
+
+# Hierarchy of equigrids whose cells double in size from one level to the next, starting from
+# thetaX x thetaY. Every geometry lives on the first level where its MBR spans at most two cells
+# per axis, so large geometries no longer fill thousands of fine cells. A pair is matched on the
+# coarser level of its two geometries, and is then reported with exactly the common blocks an
+# EquiGrid(thetaX, thetaY) would give it: candidate pairs, common blocks and getNoOfBlocks are
+# the same as the single grid's, only cheaper to enumerate on skewed data.
+class AdaptiveGrid:
+    def __init__(self, thetaX, thetaY, upperInclusive = True):
+        self.thetaX = thetaX
+        self.thetaY = thetaY
+        self.upperInclusive = upperInclusive
+        self.baseGrid = EquiGrid(thetaX, thetaY, upperInclusive)
+        self.sourceRanges = tuple(np.empty(0, dtype=np.int64) for _ in range(4))
+        self.sourceLevels = np.empty(0, dtype=np.int64)
+        self.maxLevel = 0
+        self.levelGrids = []
+        self.coarseGrids = {}
+        self.bounds = np.empty((0, 4))
+
+    def getLevels(self, bounds):
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        extents = np.fmax((bounds[:, 2] - bounds[:, 0]) / self.thetaX, (bounds[:, 3] - bounds[:, 1]) / self.thetaY)
+        extents = np.nan_to_num(extents, nan=0.0)
+        return np.ceil(np.log2(np.maximum(extents, 1.0))).astype(np.int64)
+
+    def getLevelGrid(self, level, sourceIds):
+        grid = EquiGrid(self.thetaX * 2 ** level, self.thetaY * 2 ** level, self.upperInclusive)
+        grid.build(self.bounds[sourceIds])
+        return grid, sourceIds
+
+    def build(self, bounds):
+        self.bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        self.sourceRanges = self.baseGrid.getCellRanges(self.bounds)
+        self.sourceLevels = self.getLevels(self.bounds)
+        self.maxLevel = int(self.sourceLevels.max()) if len(self.sourceLevels) else 0
+        self.levelGrids = [self.getLevelGrid(level, np.flatnonzero(self.sourceLevels == level)) for level in range(self.maxLevel + 1)]
+        self.coarseGrids = {}
+        return self
+
+    # all sources up to the given level, indexed on that level; built the first time targets need it
+    def getCoarseGrid(self, level):
+        if level == 0:
+            return self.levelGrids[0]
+        if level not in self.coarseGrids:
+            self.coarseGrids[level] = self.getLevelGrid(level, np.flatnonzero(self.sourceLevels <= level))
+        return self.coarseGrids[level]
+
+    # same contract as EquiGrid.getCandidatePairs
+    def getCandidatePairs(self, targetBounds, firstTargetId = 0):
+        targetBounds = np.asarray(targetBounds, dtype=np.float64).reshape(-1, 4)
+        targetLevels = np.minimum(self.getLevels(targetBounds), self.maxLevel)
+        sourceParts, targetParts = [], []
+        for level in range(self.maxLevel + 1):
+            # targets on this level meet every smaller source here, larger sources on their own level
+            for targets, useCoarseGrid in ((np.flatnonzero(targetLevels == level), True), (np.flatnonzero(targetLevels < level), False)):
+                if len(targets) == 0:
+                    continue
+                grid, gridIds = self.getCoarseGrid(level) if useCoarseGrid else self.levelGrids[level]
+                sourceIds, targetIds, commonBlocks = grid.getCandidatePairs(targetBounds[targets])
+                sourceParts.append(gridIds[sourceIds])
+                targetParts.append(targets[targetIds])
+
+        sourceIds = np.concatenate(sourceParts) if sourceParts else np.empty(0, dtype=np.int64)
+        targetIds = np.concatenate(targetParts) if targetParts else np.empty(0, dtype=np.int64)
+        targetRanges = self.baseGrid.getCellRanges(targetBounds)
+        commonBlocks = countCommonCells([r[sourceIds] for r in self.sourceRanges], [r[targetIds] for r in targetRanges])
+        # pairs that only meet on a coarser level share no cell of the base grid
+        shared = 0 < commonBlocks
+        sourceIds, targetIds, commonBlocks = sourceIds[shared], targetIds[shared], commonBlocks[shared]
+        order = np.lexsort((sourceIds, targetIds))
+        return sourceIds[order], targetIds[order] + firstTargetId, commonBlocks[order]
+
+    def getNoOfBlocks(self, bounds):
+        return self.baseGrid.getNoOfBlocks(bounds)
+
+    def getNoOfEntries(self):
+        return sum(grid.getNoOfEntries() for grid, gridIds in self.levelGrids)
+
+    # the levels are rebuilt from the current bounds of all geometries
+    def update(self, bounds, geometryIds):
+        return self.build(bounds)
+
+# Packed R-tree over the source MBRs (shapely.STRtree), queried in bulk with the target MBRs.
+# It reports the pairs whose MBRs intersect, and gives each pair the number of cells it shares
+# on an EquiGrid(thetaX, thetaY), so the common-block weights and features keep their meaning.
+class STRtreeIndex:
+    def __init__(self, thetaX, thetaY, upperInclusive = True):
+        self.thetaX = thetaX
+        self.thetaY = thetaY
+        self.upperInclusive = upperInclusive
+        self.baseGrid = EquiGrid(thetaX, thetaY, upperInclusive)
+        self.sourceRanges = tuple(np.empty(0, dtype=np.int64) for _ in range(4))
+        self.treeIds = np.empty(0, dtype=np.int64)
+        self.tree = None
+
+    # boxes of the rows with defined bounds, and the ids of those rows
+    def getBoxes(self, bounds):
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        ids = np.flatnonzero(~np.isnan(bounds).any(axis=1))
+        return shapely.box(*bounds[ids].T), ids
+
+    def build(self, bounds):
+        self.sourceRanges = self.baseGrid.getCellRanges(bounds)
+        boxes, self.treeIds = self.getBoxes(bounds)
+        self.tree = shapely.STRtree(boxes)
+        return self
+
+    # same contract as EquiGrid.getCandidatePairs
+    def getCandidatePairs(self, targetBounds, firstTargetId = 0):
+        boxes, boxIds = self.getBoxes(targetBounds)
+        queryIds, treeIds = self.tree.query(boxes)
+        sourceIds, targetIds = self.treeIds[treeIds], boxIds[queryIds]
+        order = np.lexsort((sourceIds, targetIds))
+        sourceIds, targetIds = sourceIds[order], targetIds[order]
+        targetRanges = self.baseGrid.getCellRanges(targetBounds)
+        commonBlocks = countCommonCells([r[sourceIds] for r in self.sourceRanges], [r[targetIds] for r in targetRanges])
+        return sourceIds, targetIds + firstTargetId, commonBlocks
+
+    def getNoOfBlocks(self, bounds):
+        return self.baseGrid.getNoOfBlocks(bounds)
+
+    def getNoOfEntries(self):
+        return len(self.treeIds)
+
+    # STRtrees are immutable, so the tree is packed again from the current bounds of all geometries
+    def update(self, bounds, geometryIds):
+        return self.build(bounds)
+
+def createIndex(indexType, thetaX, thetaY, upperInclusive = True):
+    if indexType == 'equigrid':
+        return EquiGrid(thetaX, thetaY, upperInclusive)
+    if indexType == 'refpoint':
+        return EquiGrid(thetaX, thetaY, upperInclusive, referencePoint = True)
+    if indexType == 'adaptive':
+        return AdaptiveGrid(thetaX, thetaY, upperInclusive)
+    if indexType == 'strtree':
+        return STRtreeIndex(thetaX, thetaY, upperInclusive)
+    raise ValueError("Unknown index type " + str(indexType))
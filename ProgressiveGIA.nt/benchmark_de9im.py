@@ -0,0 +1,81 @@
+import sys
+import time
+import numpy as np
+import shapely
+from utilities import CsvReader, TargetData
+from spatialindex import EquiGrid
+import mbr
+from de9im_patterns import relation_matcher, contains, crosses_lines, crosses_1, crosses_2, equal, intersects, overlaps1, overlaps2, touches, within, covered_by, covers
+from de9im_patterns import INTERSECTS, WITHIN, COVERED_BY, CROSSES, OVERLAPS, EQUALS, TOUCHES, CONTAINS, COVERS
+
+# Matches the DE-9IM matrices of real candidate pairs against every relation, once with the
+# pattern classes as verifyRelations used to, and once with the compiled matcher, both with an
+# empty memo (every distinct matrix compiled once) and with a warm one.
+#
+#   python benchmark_de9im.py source.csv target.csv [pairs] [repeats]
+
+main_dir = '/home/njdaras/Downloads/data/'
+
+sourceFilePath = sys.argv[1] if 1 < len(sys.argv) else main_dir + 'regions_gr.csv'
+targetFilePath = sys.argv[2] if 2 < len(sys.argv) else main_dir + 'wildlife_sanctuaries.csv'
+noOfPairs = int(sys.argv[3]) if 3 < len(sys.argv) else 100000
+repeats = int(sys.argv[4]) if 4 < len(sys.argv) else 3
+
+def matchPatterns(array):
+    mask = 0
+    if intersects.matches(array):
+        mask |= INTERSECTS
+    if within.matches(array):
+        mask |= WITHIN
+    if covered_by.matches(array):
+        mask |= COVERED_BY
+    if crosses_lines.matches(array) or crosses_1.matches(array) or crosses_2.matches(array):
+        mask |= CROSSES
+    if overlaps1.matches(array) or overlaps2.matches(array):
+        mask |= OVERLAPS
+    if equal.matches(array):
+        mask |= EQUALS
+    if touches.matches(array):
+        mask |= TOUCHES
+    if contains.matches(array):
+        mask |= CONTAINS
+    if covers.matches(array):
+        mask |= COVERS
+    return mask
+
+def timeMatching(match, matrices):
+    times = []
+    for _ in range(repeats):
+        time1 = time.perf_counter()
+        masks = [match(array) for array in matrices]
+        times.append(time.perf_counter() - time1)
+    return min(times), masks
+
+sources = CsvReader.loadAllEntities('\t', sourceFilePath)
+targetData = TargetData('\t', targetFilePath)
+thetaX = float(np.mean(sources.bounds[:, 2] - sources.bounds[:, 0]))
+thetaY = float(np.mean(sources.bounds[:, 3] - sources.bounds[:, 1]))
+grid = EquiGrid(thetaX, thetaY, upperInclusive = False).build(sources.bounds)
+matrices = []
+for firstId, targetChunk, targetBounds in targetData.chunks():
+    sourceIds, targetIds, commonBlocks = grid.getCandidatePairs(targetBounds)
+    valid = mbr.intersects(sources.bounds[sourceIds], targetBounds[targetIds])
+    sourceIds, targetIds = sourceIds[valid][:noOfPairs - len(matrices)], targetIds[valid][:noOfPairs - len(matrices)]
+    matrices.extend(shapely.relate(sources.geometries[sourceIds], targetChunk[targetIds]).tolist())
+    if noOfPairs <= len(matrices):
+        break
+print("Matrices", len(matrices), "distinct", len(set(matrices)))
+
+patternTime, patternMasks = timeMatching(matchPatterns, matrices)
+coldTimes = []
+for _ in range(repeats):
+    relation_matcher.masks.clear()
+    time1 = time.perf_counter()
+    coldMasks = [relation_matcher.getMask(array) for array in matrices]
+    coldTimes.append(time.perf_counter() - time1)
+warmTime, warmMasks = timeMatching(relation_matcher.getMask, matrices)
+assert patternMasks == coldMasks == warmMasks
+
+print("matcher\tms\tns per matrix")
+for name, seconds in (('patterns', patternTime), ('compiled, cold', min(coldTimes)), ('compiled, warm', warmTime)):
+    print("%s\t%.1f\t%.0f" % (name, seconds * 1000, seconds * 1e9 / max(len(matrices), 1)))
@@ -0,0 +1,45 @@
+import sys
+import time
+import numpy as np
+from utilities import CsvReader, TargetData
+from spatialindex import createIndex
+import mbr
+
+# Compares the filtering backends on the same inputs: every index is built over the source
+# MBRs with the thetas setThetas would pick, and then asked for the candidate pairs of all
+# targets, chunk by chunk, as ProgressiveGIAnt.initialization does.
+#
+#   python benchmark_filtering.py source.csv target.csv [repeats]
+
+main_dir = '/home/njdaras/Downloads/data/'
+
+sourceFilePath = sys.argv[1] if 1 < len(sys.argv) else main_dir + 'regions_gr.csv'
+targetFilePath = sys.argv[2] if 2 < len(sys.argv) else main_dir + 'wildlife_sanctuaries.csv'
+repeats = int(sys.argv[3]) if 3 < len(sys.argv) else 3
+
+sourceBounds = CsvReader.loadAllEntities('\t', sourceFilePath).bounds
+targetData = TargetData('\t', targetFilePath)
+targetChunks = [(firstId, targetBounds) for firstId, targetChunk, targetBounds in targetData.chunks()]
+thetaX = float(np.mean(sourceBounds[:, 2] - sourceBounds[:, 0]))
+thetaY = float(np.mean(sourceBounds[:, 3] - sourceBounds[:, 1]))
+print("Source geometries", len(sourceBounds), "target geometries", len(targetData))
+print("Dimensions of Equigrid", thetaX, "and", thetaY)
+
+print("index\tbuild ms\tquery ms\tentries\tpairs\tvalid pairs\tcommon blocks")
+for indexType in ('equigrid', 'refpoint', 'adaptive', 'strtree'):
+    buildTimes, queryTimes = [], []
+    for _ in range(repeats):
+        time1 = time.perf_counter()
+        index = createIndex(indexType, thetaX, thetaY, upperInclusive = False).build(sourceBounds)
+        buildTimes.append(time.perf_counter() - time1)
+        noOfPairs, noOfValidPairs, totalBlocks, queryTime = 0, 0, 0, 0
+        for firstId, targetBounds in targetChunks:
+            time1 = time.perf_counter()
+            sourceIds, targetIds, commonBlocks = index.getCandidatePairs(targetBounds, firstId)
+            queryTime += time.perf_counter() - time1
+            noOfPairs += len(sourceIds)
+            noOfValidPairs += int(np.count_nonzero(mbr.intersects(sourceBounds[sourceIds], targetBounds[targetIds - firstId])))
+            totalBlocks += int(commonBlocks.sum())
+        queryTimes.append(queryTime)
+    print("%s\t%.1f\t%.1f\t%d\t%d\t%d\t%d" % (indexType, min(buildTimes) * 1000, min(queryTimes) * 1000,
+                                              index.getNoOfEntries(), noOfPairs, noOfValidPairs, totalBlocks))
@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import numpy as np
+import shapely
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from utilities import CsvReader, TargetData
+from spatialindex import EquiGrid
+import mbr
+from datamodel import RelatedGeometries
+from geometrystore import SharedWKBStore
+from progressivegiant import ProgressiveGIAnt
+
+# Verifies the candidate pairs of real data in batches, serially as verification does by default,
+# with the threads of RelatedGeometries and with a process pool over a shared-memory source store
+# as parallelVerification does, for 2, 4, ... workers, and checks they all record the same links.
+#
+#   python benchmark_verification.py source.csv target.csv [pairs] [workers] [repeats]
+
+main_dir = '/home/njdaras/Downloads/data/'
+
+sourceFilePath = sys.argv[1] if 1 < len(sys.argv) else main_dir + 'regions_gr.csv'
+targetFilePath = sys.argv[2] if 2 < len(sys.argv) else main_dir + 'wildlife_sanctuaries.csv'
+noOfPairs = int(sys.argv[3]) if 3 < len(sys.argv) else 100000
+maxWorkers = int(sys.argv[4]) if 4 < len(sys.argv) else os.cpu_count()
+repeats = int(sys.argv[5]) if 5 < len(sys.argv) else 3
+batchSize = 4096
+
+def getResults(relations):
+    return (relations.verifiedPairs, relations.interlinkedGeometries, relations.pgr, relations.detectedLinks,
+            relations.intersectsD1, relations.intersectsD2, relations.withinD1, relations.containsD1, relations.touchesD1)
+
+def verifySerially(workers):
+    relations = RelatedGeometries(0)
+    for start in range(0, len(sourceIds), batchSize):
+        relations.verifyRelationsBatch(sourceIds[start:start + batchSize], targetIds[start:start + batchSize],
+                                       sources.geometries[sourceIds[start:start + batchSize]], targetGeoms[start:start + batchSize])
+    return relations
+
+def verifyWithThreads(workers):
+    relations = RelatedGeometries(0)
+    relations.setThreads(workers)
+    for start in range(0, len(sourceIds), batchSize):
+        relations.submitRelationsBatch(sourceIds[start:start + batchSize], targetIds[start:start + batchSize],
+                                       sources.geometries[sourceIds[start:start + batchSize]], targetGeoms[start:start + batchSize])
+    relations.flush()
+    relations.shutdown()
+    return relations
+
+def verifyWithProcesses(workers):
+    relations = RelatedGeometries(0)
+    starts = range(0, len(sourceIds), batchSize)
+    storedSources, storePositions = np.unique(sourceIds, return_inverse=True)
+    pendingBatches = deque()
+    with SharedWKBStore.create(sources.geometries[storedSources], sources.bounds[storedSources]) as sourceStore, ProcessPoolExecutor(max_workers=workers) as executor:
+        for start in starts:
+            pendingBatches.append((start, executor.submit(ProgressiveGIAnt.relatePairs, sourceStore, storePositions[start:start + batchSize],
+                                                          shapely.to_wkb(targetGeoms[start:start + batchSize]))))
+            while pendingBatches and (2 * workers < len(pendingBatches) or pendingBatches[0][1].done() or start == starts[-1]):
+                batchStart, future = pendingBatches.popleft()
+                relations.addRelationsBatch(sourceIds[batchStart:batchStart + batchSize], targetIds[batchStart:batchStart + batchSize], future.result())
+    return relations
+
+def timeVerification(verify, workers):
+    times = []
+    for _ in range(repeats):
+        time1 = time.perf_counter()
+        relations = verify(workers)
+        times.append(time.perf_counter() - time1)
+    return min(times), getResults(relations)
+
+sources = CsvReader.loadAllEntities('\t', sourceFilePath)
+targetData = TargetData('\t', targetFilePath)
+thetaX = float(np.mean(sources.bounds[:, 2] - sources.bounds[:, 0]))
+thetaY = float(np.mean(sources.bounds[:, 3] - sources.bounds[:, 1]))
+grid = EquiGrid(thetaX, thetaY, upperInclusive = False).build(sources.bounds)
+sourceParts, targetParts, geometryParts = [], [], []
+for firstId, targetChunk, targetBounds in targetData.chunks():
+    chunkSources, chunkTargets, commonBlocks = grid.getCandidatePairs(targetBounds)
+    valid = mbr.intersects(sources.bounds[chunkSources], targetBounds[chunkTargets])
+    sourceParts.append(chunkSources[valid])
+    targetParts.append(firstId + chunkTargets[valid])
+    geometryParts.append(targetChunk[chunkTargets[valid]])
+    if noOfPairs <= sum(len(part) for part in sourceParts):
+        break
+sourceIds = np.concatenate(sourceParts + [np.empty(0, dtype=np.int64)])[:noOfPairs]
+targetIds = np.concatenate(targetParts + [np.empty(0, dtype=np.int64)])[:noOfPairs]
+targetGeoms = np.concatenate(geometryParts + [np.empty(0, dtype=object)])[:noOfPairs]
+print("Pairs", len(sourceIds), "distinct sources", len(np.unique(sourceIds)))
+
+serialTime, serialResults = timeVerification(verifySerially, 1)
+print("engine\tworkers\tms\tspeedup")
+print("serial\t1\t%.1f\t1.00" % (serialTime * 1000))
+workers = 2
+while workers <= max(maxWorkers, 2):
+    for name, verify in (('threads', verifyWithThreads), ('processes', verifyWithProcesses)):
+        seconds, results = timeVerification(verify, workers)
+        assert results == serialResults
+        print("%s\t%d\t%.1f\t%.2f" % (name, workers, seconds * 1000, serialTime / seconds))
+    workers *= 2
@@ -0,0 +1,37 @@
+import numpy as np
+
+# Rectangle arithmetic over (n, 4) bounds arrays laid out as shapely's bounds (minX, minY, maxX, maxY).
+# Rows of the two arguments are paired up, and either side may be a single row that is broadcast;
+# the results match the shapely envelope operations without building any geometry.
+
+def asBounds(bounds):
+    return np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+
+def getAreas(bounds):
+    bounds = asBounds(bounds)
+    return (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+
+# envelope.intersects: closed rectangles, so touching MBRs intersect
+def intersects(bounds1, bounds2):
+    bounds1, bounds2 = asBounds(bounds1), asBounds(bounds2)
+    return ((bounds1[:, 0] <= bounds2[:, 2]) & (bounds2[:, 0] <= bounds1[:, 2]) &
+            (bounds1[:, 1] <= bounds2[:, 3]) & (bounds2[:, 1] <= bounds1[:, 3]))
+
+# envelope.intersection(...).area, which is 0 for disjoint MBRs
+def getIntersectionAreas(bounds1, bounds2):
+    bounds1, bounds2 = asBounds(bounds1), asBounds(bounds2)
+    widths = np.minimum(bounds1[:, 2], bounds2[:, 2]) - np.maximum(bounds1[:, 0], bounds2[:, 0])
+    heights = np.minimum(bounds1[:, 3], bounds2[:, 3]) - np.maximum(bounds1[:, 1], bounds2[:, 1])
+    return np.maximum(widths, 0) * np.maximum(heights, 0)
+
+# area covered by either MBR
+def getUnionAreas(bounds1, bounds2, intersectionAreas = None):
+    if intersectionAreas is None:
+        intersectionAreas = getIntersectionAreas(bounds1, bounds2)
+    return getAreas(bounds1) + getAreas(bounds2) - intersectionAreas
+
+# intersection over union of the MBRs, 0 where both are degenerate
+def getJaccard(bounds1, bounds2):
+    intersectionAreas = getIntersectionAreas(bounds1, bounds2)
+    unionAreas = getUnionAreas(bounds1, bounds2, intersectionAreas)
+    return np.divide(intersectionAreas, unionAreas, out=np.zeros_like(intersectionAreas), where=unionAreas != 0)
@@ -0,0 +1,57 @@
+import math
+import numpy as np
+from spatialindex import expandRanges
+
+# Uniform tiling of the joint extent of the source and target MBRs, for running the join tile by
+# tile. Every geometry is replicated to all the tiles its MBR overlaps, and a pair of intersecting
+# MBRs belongs only to the tile holding the lower-left corner of their intersection, so each pair
+# is processed exactly once however many tiles its two geometries share.
+class TilePartitioner:
+    def __init__(self, sourceBounds, targetBounds, noOfTiles):
+        bounds = np.concatenate((np.asarray(sourceBounds, dtype=np.float64).reshape(-1, 4),
+                                 np.asarray(targetBounds, dtype=np.float64).reshape(-1, 4)))
+        bounds = bounds[~np.isnan(bounds).any(axis=1)]
+        if len(bounds) == 0:
+            bounds = np.zeros((1, 4))
+        self.minX, self.minY = float(bounds[:, 0].min()), float(bounds[:, 1].min())
+        width = max(float(bounds[:, 2].max()) - self.minX, np.finfo(np.float64).tiny)
+        height = max(float(bounds[:, 3].max()) - self.minY, np.finfo(np.float64).tiny)
+        # tiles as close to square as the extent allows
+        self.noOfColumns = min(max(1, round(math.sqrt(noOfTiles * width / height))), noOfTiles)
+        self.noOfRows = max(1, math.ceil(noOfTiles / self.noOfColumns))
+        self.tileWidth = width / self.noOfColumns
+        self.tileHeight = height / self.noOfRows
+
+    def getNoOfTiles(self):
+        return self.noOfColumns * self.noOfRows
+
+    def getColumns(self, x):
+        return np.clip(np.floor((x - self.minX) / self.tileWidth), 0, self.noOfColumns - 1).astype(np.int64)
+
+    def getRows(self, y):
+        return np.clip(np.floor((y - self.minY) / self.tileHeight), 0, self.noOfRows - 1).astype(np.int64)
+
+    # ids of the geometries that overlap every tile, ascending; empty geometries go nowhere
+    def assign(self, bounds):
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        valid = ~np.isnan(bounds).any(axis=1)
+        bounds = np.where(valid[:, None], bounds, self.minX)
+        minColumns, maxColumns = self.getColumns(bounds[:, 0]), self.getColumns(bounds[:, 2])
+        minRows, maxRows = self.getRows(bounds[:, 1]), self.getRows(bounds[:, 3])
+        heights = maxRows - minRows + 1
+        counts = np.where(valid, (maxColumns - minColumns + 1) * heights, 0)
+
+        ids = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+        local = expandRanges(np.zeros(len(counts)), counts)
+        repeatedHeights = np.repeat(heights, counts)
+        tiles = (np.repeat(minColumns, counts) + local // repeatedHeights) * self.noOfRows + np.repeat(minRows, counts) + local % repeatedHeights
+        order = np.argsort(tiles, kind='stable')
+        offsets = np.searchsorted(tiles[order], np.arange(self.getNoOfTiles() + 1))
+        ids = ids[order]
+        return [ids[offsets[tile]:offsets[tile + 1]] for tile in range(self.getNoOfTiles())]
+
+    # tile that owns each pair of (row-aligned) intersecting MBRs
+    def getReferenceTiles(self, bounds1, bounds2):
+        x = np.maximum(bounds1[:, 0], bounds2[:, 0])
+        y = np.maximum(bounds1[:, 1], bounds2[:, 1])
+        return self.getColumns(x) * self.noOfRows + self.getRows(y)
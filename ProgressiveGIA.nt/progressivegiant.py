@@ -1,47 +1,63 @@
-import math
 import numpy as np
 import random
+import shapely
 import sys
 import time
 import pandas as pd
-from collections import defaultdict
 from sklearn.linear_model import LogisticRegression
 from shapely.geometry import LineString, MultiPolygon, Polygon
 from sklearn.neighbors import KernelDensity
 from sklearn.model_selection import GridSearchCV
 from sklearn.model_selection import LeaveOneOut
-from utilities import CsvReader
+from utilities import CsvReader, SourceData, TargetData
 from datamodel import RelatedGeometries
-from queue import PriorityQueue
+from spatialindex import EquiGrid, createIndex
+import mbr
+from partitioning import TilePartitioner
+from geometrystore import SharedWKBStore
+from topk import TopKPairs
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 class ProgressiveGIAnt :
 
-    def __init__(self, budget,  qPairs,  delimiter,  sourceFilePath,  targetFilePath, wScheme) :
+    def __init__(self, budget,  qPairs,  delimiter,  sourceFilePath,  targetFilePath, wScheme, streamTargets = False, targetChunkSize = CsvReader.BATCH_SIZE, readWorkers = 1, sourceIndexPath = None, indexType = 'equigrid', joinWorkers = 1, streamSources = False, verificationWorkers = 1, verificationThreads = 1) :
         self.budget = budget
         self.datasetDelimiter = len(sourceFilePath)
         self.delimiter = delimiter
         self.relations = RelatedGeometries(qPairs)
-        self.sourceData = CsvReader.readAllEntities(delimiter, sourceFilePath)
-        self.spatialIndex = defaultdict(lambda: defaultdict(list))
+        self.relations.setThreads(verificationThreads)
+        # out of core, only the source bounds are held in memory and geometries are decoded on demand
+        self.streamSources = streamSources
+        if streamSources:
+          self.sourceData = SourceData(delimiter, sourceFilePath)
+          self.sourceBounds = self.sourceData.getBounds()
+        else:
+          sourceEntities = CsvReader.loadAllEntities(delimiter, sourceFilePath, workers = readWorkers)
+          self.sourceData = sourceEntities.geometries
+          self.sourceBounds = sourceEntities.bounds
+        self.sourceFilePath = sourceFilePath
+        self.sourceIndexPath = sourceIndexPath
+        self.indexType = indexType
+        self.spatialIndex = None
         self.targetFilePath = targetFilePath
+        self.targetData = TargetData(delimiter, targetFilePath, streamTargets, targetChunkSize, readWorkers)
         self.thetaX = -1
         self.thetaY = -1
         self.wScheme = wScheme
+        self.THETA_DRIFT = 0.25
+        self.VERIFICATION_BATCH = 4096
+        self.TILES_PER_WORKER = 4
+        self.BATCHES_PER_WORKER = 4
+        self.joinWorkers = joinWorkers
+        self.verificationWorkers = verificationWorkers
+        self.partitioner = None
 
     def getMethodName(self):
       return 'progressive GIA.nt'
 
 
-    def addToIndex(self, geometryId, envelope) :
-        maxX = math.ceil(envelope[2] / self.thetaX)
-        maxY = math.ceil(envelope[3] / self.thetaY)
-        minX = math.floor(envelope[0] / self.thetaX)
-        minY = math.floor(envelope[1] / self.thetaY)
-
-        for latIndex in range(minX, maxX):
-          for longIndex in range(minY, maxY):
-              self.spatialIndex[latIndex][longIndex].append(geometryId)
-
     def applyProcessing(self) :
       time1 = int(time.time() * 1000)
 
@@ -61,88 +77,129 @@ class ProgressiveGIAnt :
       self.verificationTime = time4 - time3;
       self.printResults()
 
+    # Links as the run finds them, while it goes on; see RelatedGeometries.iterLinks. Closing it
+    # stops initialization at the next target chunk or tile, and verification at the next recorded
+    # batch, and the verification threads or the process pool of verificationWorkers drop the
+    # batches not started yet. Partitioned verification records its pairs only once the pool is
+    # done, so there closing spares the consumer alone.
+    def iterLinks(self, bufferSize = 64):
+        return self.relations.iterLinks(self.applyProcessing, bufferSize)
+
+    # with more than one joinWorkers, the join runs partitioned: space is split into tiles, and
+    # filtering, weighting and verification run tile by tile in a process pool
     def filtering(self):
         self.setThetas()
-        self.indexSource()
+        if 1 < self.joinWorkers:
+            self.partitioner = TilePartitioner(self.sourceBounds, self.targetData.getBounds(), self.joinWorkers * self.TILES_PER_WORKER)
+        else:
+            self.indexSource()
 
 
 
+    # candidates of a single target; freq holds the number of cells each of them shares with it
     def getCandidates(self, targetId, tEntity):
-        candidates = set()
-
-        envelope = tEntity.envelope.bounds
-        maxX = math.ceil(envelope[2] / self.thetaX)
-        maxY = math.ceil(envelope[3] / self.thetaY)
-        minX = math.floor(envelope[0] / self.thetaX)
-        minY = math.floor(envelope[1] / self.thetaY)
-
-        for latIndex in range(minX, maxX):
-          for longIndex in range(minY,maxY):
-              for sourceId in self.spatialIndex[latIndex][longIndex]:
-                  if (self.flag[sourceId] == -1):
-                      self.flag[sourceId] = targetId
-                      self.freq[sourceId] = 0
-                  self.freq[sourceId] += 1
-                  candidates.add(sourceId)
-
+        candidates, targetIds, commonBlocks = self.spatialIndex.getCandidatePairs(tEntity.bounds, targetId)
+        self.freq[candidates] = commonBlocks
         return candidates
 
 
 
 
     def getNoOfBlocks(self,envelope) :
-      maxX = math.ceil(envelope[2] / self.thetaX)
-      maxY = math.ceil(envelope[3] / self.thetaY)
-      minX = math.floor(envelope[0] / self.thetaX)
-      minY = math.floor(envelope[1] / self.thetaY)
-      return (maxX - minX + 1) * (maxY - minY + 1)
-
-    def getWeight(self,sourceId, tEntity) :
-      commonBlocks = self.freq[sourceId]
-      if self.wScheme == 'CF':
+      return int(self.spatialIndex.getNoOfBlocks(envelope)[0])
+
+    def getWeight(self,sourceId, tEntity, commonBlocks) :
+      return self.getWeights(np.array([sourceId]), np.array([tEntity.bounds]), np.array([commonBlocks])).tolist()[0]
+
+    # weights of whole candidate arrays, computed on the bounds rather than on shapely envelopes
+    def getWeights(self, sourceIds, targetBounds, commonBlocks) :
+      return ProgressiveGIAnt.weighPairs(self.wScheme, self.spatialIndex, self.sourceBounds[sourceIds], targetBounds, commonBlocks)
+
+    # sourceBounds and targetBounds hold the MBRs of the two sides of every pair
+    def weighPairs(wScheme, spatialIndex, sourceBounds, targetBounds, commonBlocks) :
+      if wScheme == 'CF':
         return commonBlocks
-      elif self.wScheme == 'JS_APPROX':
-        return commonBlocks / (self.getNoOfBlocks(self.sourceData[sourceId].envelope) + self.getNoOfBlocks(tEntity.envelope) - commonBlocks)
-      elif self.wScheme == 'MBR':
-        srcEnv = self.sourceData[sourceId].envelope
-        trgEnv = tEntity.envelope
-        mbrIntersection = srcEnv.intersection(trgEnv);
-        denominator = srcEnv.area + trgEnv.area - mbrIntersection.area
-        if denominator == 0 :
-          return 0
-        return mbrIntersection.area/denominator
-      return 1.0
+      elif wScheme == 'JS_APPROX':
+        return commonBlocks / (spatialIndex.getNoOfBlocks(sourceBounds) + spatialIndex.getNoOfBlocks(targetBounds) - commonBlocks)
+      elif wScheme == 'MBR':
+        return mbr.getJaccard(sourceBounds, targetBounds)
+      return np.ones(len(sourceBounds))
 
+    # with a sourceIndexPath, the equigrid built in an earlier run over the same source file is reused
     def indexSource(self) :
-      geometryId = 0
-      for sEntity in self.sourceData:
-        self.addToIndex(geometryId, sEntity.bounds)
-        geometryId += 1
+      if self.sourceIndexPath is not None and self.indexType in ('equigrid', 'refpoint'):
+        metadata = {'source': CsvReader.getCacheKey(self.delimiter, self.sourceFilePath), 'upperInclusive': False, 'indexType': self.indexType}
+        storedIndex = EquiGrid.open(self.sourceIndexPath, metadata)
+        if storedIndex is not None:
+          self.spatialIndex = storedIndex[0]
+          return
+
+      self.spatialIndex = createIndex(self.indexType, self.thetaX, self.thetaY, upperInclusive = False).build(self.sourceBounds)
+      if self.sourceIndexPath is not None and self.indexType in ('equigrid', 'refpoint'):
+        try:
+          self.spatialIndex.save(self.sourceIndexPath, metadata)
+        except OSError as e:
+          print("Could not write source index", self.sourceIndexPath, e)
 
     def validCandidate(self, candidateId, targetEnv):
-        return self.sourceData[candidateId].envelope.intersects(targetEnv)
-
-    def initialization(self): # reads target geometries on the fly
-        self.flag = [-1] * len(self.sourceData)
-        self.freq = [-1] * len(self.sourceData)
-        self.topKPairs = PriorityQueue(maxsize = self.budget + 1)
-
-        geoCollections = 0
-        minimumWeight = -1
-        targetId, totalDecisions, positiveDecisions, truePositiveDecisions = 0, 0, 0, 0
-        targetData = CsvReader.readAllEntities("\t", self.targetFilePath)
-
-        for targetGeom in targetData:
-          candidates = self.getCandidates(targetId,targetGeom)
-          for candidateMatchId in candidates:
-                    if (self.validCandidate(candidateMatchId, targetGeom.envelope)):
-                        weight = self.getWeight(candidateMatchId, targetGeom)
-                        if (minimumWeight <= weight):
-                          self.topKPairs.put((weight, candidateMatchId, targetId, targetGeom))
-                          if (self.budget < self.topKPairs.qsize()):
-                              minimumWeight = self.topKPairs.get()[0]
-          targetId += 1
-        print("Total target geometries", targetId)
+        return bool(mbr.intersects(self.sourceBounds[candidateId], targetEnv.bounds)[0])
+
+    # reads target geometries on the fly, one chunk at a time; the top-K keeps only the ids of
+    # the pairs, and verification fetches the geometries of its targets again
+    def initialization(self):
+        if self.partitioner is not None:
+          return self.partitionedInitialization()
+        self.freq = np.zeros(len(self.sourceData), dtype=np.int64)
+        self.topKPairs = TopKPairs(self.budget)
+        noOfTargets = 0
+
+        for firstId, targetChunk, targetBounds in self.targetData.chunks():
+          self.relations.checkCancelled()
+          sourceIds, targetIds, commonBlocks = self.spatialIndex.getCandidatePairs(targetBounds, firstId)
+          valid = mbr.intersects(self.sourceBounds[sourceIds], targetBounds[targetIds - firstId])
+          sourceIds, targetIds = sourceIds[valid], targetIds[valid]
+          self.topKPairs.add(self.getWeights(sourceIds, targetBounds[targetIds - firstId], commonBlocks[valid]), sourceIds, targetIds)
+          noOfTargets = firstId + len(targetChunk)
+        print("Total target geometries", noOfTargets)
+
+    # The top-K keeps the budget largest pairs in (weight, source id, target id) order, so the
+    # union of the top pairs of every tile holds the global ones; topPairs keeps those in the
+    # order verification takes them, along with the tile each pair belongs to.
+    def partitionedInitialization(self):
+        sourceTiles = self.partitioner.assign(self.sourceBounds)
+        targetBounds = self.targetData.getBounds()
+        targetTiles = self.partitioner.assign(targetBounds)
+        tiles = [tile for tile in range(self.partitioner.getNoOfTiles()) if len(sourceTiles[tile]) and len(targetTiles[tile])]
+        topKPairs = TopKPairs(self.budget)
+        with ProcessPoolExecutor(max_workers=self.joinWorkers) as executor:
+          try:
+            for weights, sourceIds, targetIds in executor.map(ProgressiveGIAnt.processTile, tiles, repeat(self.partitioner),
+                                                              [sourceTiles[tile] for tile in tiles], [self.sourceBounds[sourceTiles[tile]] for tile in tiles],
+                                                              [targetTiles[tile] for tile in tiles], [targetBounds[targetTiles[tile]] for tile in tiles],
+                                                              repeat(self.thetaX), repeat(self.thetaY), repeat(self.indexType), repeat(self.wScheme), repeat(self.budget)):
+              self.relations.checkCancelled()
+              topKPairs.add(weights, sourceIds, targetIds)
+          except BaseException:
+            # a closed iterLinks waits only for the tiles already running
+            executor.shutdown(cancel_futures = True)
+            raise
+        weights, sourceIds, targetIds = topKPairs.getPairs()
+        self.topPairs = (weights, sourceIds, targetIds, self.partitioner.getReferenceTiles(self.sourceBounds[sourceIds], targetBounds[targetIds]))
+        print("Total target geometries", len(targetBounds))
+
+    # filtering and weighting of one tile, keeping its pairs only; returns its top-K pairs
+    def processTile(tileId, partitioner, sourceIds, sourceBounds, targetIds, targetBounds, thetaX, thetaY, indexType, wScheme, budget):
+        spatialIndex = createIndex(indexType, thetaX, thetaY, upperInclusive = False).build(sourceBounds)
+        topKPairs = TopKPairs(budget)
+        for start in range(0, len(targetIds), CsvReader.BATCH_SIZE):
+          chunkBounds = targetBounds[start:start + CsvReader.BATCH_SIZE]
+          localSources, localTargets, commonBlocks = spatialIndex.getCandidatePairs(chunkBounds)
+          pairBounds1, pairBounds2 = sourceBounds[localSources], chunkBounds[localTargets]
+          owned = mbr.intersects(pairBounds1, pairBounds2)
+          owned[owned] = partitioner.getReferenceTiles(pairBounds1[owned], pairBounds2[owned]) == tileId
+          topKPairs.add(ProgressiveGIAnt.weighPairs(wScheme, spatialIndex, pairBounds1[owned], pairBounds2[owned], commonBlocks[owned]),
+                        sourceIds[localSources[owned]], targetIds[start + localTargets[owned]])
+        return topKPairs.getPairs()
 
     def printResults(self) :
       print("\n\nCurrent method", str(self.getMethodName()))
@@ -153,24 +210,116 @@ class ProgressiveGIAnt :
 
 
     def setThetas(self):
-        self.thetaX, self.thetaY = 0, 0
-        for sEntity in self.sourceData:
-            envelope = sEntity.envelope.bounds
-            self.thetaX += envelope[2] - envelope[0]
-            self.thetaY += envelope[3] - envelope[1]
-        self.thetaX /= len(self.sourceData)
-        self.thetaY /= len(self.sourceData)
+        self.thetaX, self.thetaY = self.getThetas()
         print("Dimensions of Equigrid", self.thetaX,"and", self.thetaY)
 
+    def getThetas(self):
+        # the adaptive grid starts from the typical extent and leaves the large geometries to its coarser levels
+        average = np.median if self.indexType == 'adaptive' else np.mean
+        bounds = self.sourceBounds[~np.isnan(self.sourceBounds).any(axis=1)]
+        return float(average(bounds[:, 2] - bounds[:, 0])), float(average(bounds[:, 3] - bounds[:, 1]))
+
+    # Changes to the source layer after filtering, applied to the index in place; run initialization
+    # again to take them into account. insertSources returns the ids given to the new geometries,
+    # deleted ids stay as empty slots.
+    def insertSources(self, geometries):
+        sourceIds = np.arange(len(self.sourceData), len(self.sourceData) + len(geometries))
+        if self.streamSources:
+            self.sourceData = self.sourceData.grow(len(geometries))
+        else:
+            self.sourceData = np.concatenate((self.sourceData, np.full(len(geometries), None, dtype=object)))
+        self.sourceBounds = np.concatenate((self.sourceBounds, np.full((len(geometries), 4), np.nan)))
+        self.replaceSources(sourceIds, geometries)
+        return sourceIds
+
+    def deleteSources(self, sourceIds):
+        self.replaceSources(sourceIds, [None] * len(sourceIds))
+
+    def replaceSources(self, sourceIds, geometries):
+        sourceIds = np.asarray(sourceIds, dtype=np.int64)
+        newGeometries = np.empty(len(sourceIds), dtype=object)
+        newGeometries[:] = list(geometries)
+        # the index no longer matches the source file
+        self.sourceIndexPath = None
+        if not self.sourceBounds.flags.writeable:
+            self.sourceBounds = np.array(self.sourceBounds)
+        self.sourceData[sourceIds] = newGeometries
+        self.sourceBounds[sourceIds] = shapely.bounds(newGeometries)
+
+        thetaX, thetaY = self.getThetas()
+        if self.THETA_DRIFT < max(abs(thetaX - self.thetaX) / self.thetaX, abs(thetaY - self.thetaY) / self.thetaY):
+            self.filtering()
+        elif self.partitioner is not None:
+            self.partitioner = TilePartitioner(self.sourceBounds, self.targetData.getBounds(), self.joinWorkers * self.TILES_PER_WORKER)
+        else:
+            self.spatialIndex.update(self.sourceBounds, sourceIds)
 
 
 
-    def verification(self):
-        counter = 0
-        while(not self.topKPairs.empty()):
-            counter += 1
-            weight, source_id, target_id, tEntity = self.topKPairs.get()
-            self.relations.verifyRelations(source_id, target_id, self.sourceData[source_id], tEntity)
-        print("counter is", counter)
-
 
+    def verification(self):
+        if self.partitioner is not None:
+          return self.partitionedVerification()
+        if 1 < self.verificationWorkers:
+          return self.parallelVerification()
+        # the top pairs are verified in batches, each with one relate call, or related by the
+        # threads of RelatedGeometries while the next batch is gathered
+        weights, sourceIds, targetIds = self.topKPairs.getPairs()
+        try:
+          for start in range(0, len(sourceIds), self.VERIFICATION_BATCH):
+              batchSources, batchTargets = sourceIds[start:start + self.VERIFICATION_BATCH], targetIds[start:start + self.VERIFICATION_BATCH]
+              self.relations.submitRelationsBatch(batchSources, batchTargets, self.sourceData[batchSources], self.targetData.getGeometries(batchTargets))
+          self.relations.flush()
+        finally:
+          self.relations.shutdown()
+        print("counter is", len(sourceIds))
+
+    # The DE-9IM matrices of the top pairs are computed tile by tile in the pool, and then recorded
+    # in the order of the serial verification, which the progressive measures depend on. Workers
+    # read the source geometries from a shared-memory store; the targets of a tile come as WKB.
+    def partitionedVerification(self):
+        weights, sourceIds, targetIds, tileIds = self.topPairs
+        tiles = np.unique(tileIds).tolist()
+        groups = [np.flatnonzero(tileIds == tile) for tile in tiles]
+        # only the sources of the top pairs are shared, at most budget of them
+        storedSources, storePositions = np.unique(sourceIds, return_inverse=True)
+        with SharedWKBStore.create(self.sourceData[storedSources], self.sourceBounds[storedSources]) as sourceStore, ProcessPoolExecutor(max_workers=self.joinWorkers) as executor:
+          matrices = list(executor.map(ProgressiveGIAnt.relatePairs, repeat(sourceStore), [storePositions[group] for group in groups],
+                                       [shapely.to_wkb(self.targetData.getGeometries(targetIds[group])) for group in groups]))
+        arrays = np.empty(len(sourceIds), dtype=object)
+        for group, tileMatrices in zip(groups, matrices):
+          arrays[group] = tileMatrices
+        self.relations.addRelationsBatch(sourceIds, targetIds, arrays)
+        print("counter is", len(sourceIds))
+
+    # The top pairs are cut in weight order into batches that the pool verifies, with the sources of
+    # all the pairs in a shared-memory store. The targets of a batch are encoded as it is submitted,
+    # with at most two batches per worker in flight, and results are recorded batch by batch in
+    # submission order, so links and progressive measures are those of the serial verification.
+    def parallelVerification(self):
+        weights, sourceIds, targetIds = self.topKPairs.getPairs()
+        batchSize = max(1, min(self.VERIFICATION_BATCH, -(-len(sourceIds) // (self.verificationWorkers * self.BATCHES_PER_WORKER))))
+        starts = range(0, len(sourceIds), batchSize)
+        storedSources, storePositions = np.unique(sourceIds, return_inverse=True)
+        pendingBatches = deque()
+        with SharedWKBStore.create(self.sourceData[storedSources], self.sourceBounds[storedSources]) as sourceStore, ProcessPoolExecutor(max_workers=self.verificationWorkers) as executor:
+          try:
+            for start in starts:
+              pendingBatches.append((start, executor.submit(ProgressiveGIAnt.relatePairs, sourceStore, storePositions[start:start + batchSize],
+                                                            shapely.to_wkb(self.targetData.getGeometries(targetIds[start:start + batchSize])))))
+              while pendingBatches and (2 * self.verificationWorkers < len(pendingBatches) or pendingBatches[0][1].done() or start == starts[-1]):
+                batchStart, future = pendingBatches.popleft()
+                self.relations.addRelationsBatch(sourceIds[batchStart:batchStart + batchSize], targetIds[batchStart:batchStart + batchSize], future.result())
+          except BaseException:
+            # a cancelled or failed run waits only for the batches already running
+            executor.shutdown(cancel_futures = True)
+            raise
+        print("counter is", len(sourceIds))
+
+    # DE-9IM matrices of a group of pairs; the store decodes only the sources they use, once each
+    def relatePairs(sourceStore, sourceIds, targetWkbs):
+        try:
+          storedSources, positions = np.unique(sourceIds, return_inverse=True)
+          return shapely.relate(sourceStore.decode(storedSources)[positions], shapely.from_wkb(targetWkbs))
+        finally:
+          sourceStore.close()
@@ -0,0 +1,246 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# Bounded selection of the k largest candidate pairs by (weight, source id, target id), the order in
+# which a priority queue of (weight, source id, target id, geometry) tuples keeps them, on parallel
+# arrays. Pairs are added in batches to a buffer of 2k slots; a full buffer is cut back to its k
+# largest pairs with an argpartition, and pairs below the smallest weight kept by the last cut are
+# dropped on arrival. Memory stays at 2k pairs and time is linear in the number of pairs added.
+class TopKPairs:
+    def __init__(self, k, capacity = None):
+        self.k = max(int(k), 0)
+        capacity = max(capacity or 2 * self.k, 1)
+        self.weights = np.empty(capacity, dtype=np.float64)
+        self.sourceIds = np.empty(capacity, dtype=np.int64)
+        self.targetIds = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+        self.minimumWeight = -np.inf
+
+    def __len__(self):
+        return min(self.size, self.k)
+
+    # either id argument may be a single id shared by all the pairs
+    def add(self, weights, sourceIds, targetIds):
+        # adding 0.0 turns -0.0 into 0.0, which the weight keys of the spilled runs would tell apart
+        weights = np.asarray(weights, dtype=np.float64).ravel() + 0.0
+        sourceIds = np.broadcast_to(np.asarray(sourceIds, dtype=np.int64), weights.shape)
+        targetIds = np.broadcast_to(np.asarray(targetIds, dtype=np.int64), weights.shape)
+        if self.k == 0:
+            return
+        start = 0
+        while start < len(weights):
+            end = min(start + len(self.weights) - self.size, len(weights))
+            kept = start + np.flatnonzero(self.minimumWeight <= weights[start:end])
+            count = len(kept)
+            self.weights[self.size:self.size + count] = weights[kept]
+            self.sourceIds[self.size:self.size + count] = sourceIds[kept]
+            self.targetIds[self.size:self.size + count] = targetIds[kept]
+            self.size += count
+            if self.size == len(self.weights):
+                self.compact()
+            start = end
+
+    def compact(self):
+        top = self.select()
+        self.size = len(top)
+        self.weights[:self.size] = self.weights[top]
+        self.sourceIds[:self.size] = self.sourceIds[top]
+        self.targetIds[:self.size] = self.targetIds[top]
+        if self.size == self.k:
+            self.minimumWeight = float(self.weights[:self.size].min())
+
+    # positions of the k largest buffered pairs, in no particular order
+    def select(self):
+        if self.size <= self.k:
+            return np.arange(self.size)
+        weights = self.weights[:self.size]
+        threshold = weights[np.argpartition(weights, self.size - self.k)[self.size - self.k]]
+        above = np.flatnonzero(threshold < weights)
+        # ties on the weight are broken by source id and then target id
+        tied = np.flatnonzero(weights == threshold)
+        tied = tied[np.lexsort((self.targetIds[tied], self.sourceIds[tied]))]
+        return np.concatenate((above, tied[len(tied) - (self.k - len(above)):]))
+
+    # (weights, source ids, target ids) of the k largest pairs, in ascending order, the order the
+    # priority queue gave them up in
+    def getPairs(self):
+        top = self.select()
+        top = top[np.lexsort((self.targetIds[top], self.sourceIds[top], self.weights[top]))]
+        return self.weights[top], self.sourceIds[top], self.targetIds[top]
+
+    # the same, in chunks of at most chunkSize pairs
+    def iterPairs(self, chunkSize):
+        weights, sourceIds, targetIds = self.getPairs()
+        for start in range(0, len(weights), chunkSize):
+            yield weights[start:start + chunkSize], sourceIds[start:start + chunkSize], targetIds[start:start + chunkSize]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+# A TopKPairs for k beyond what fits in memory. The buffer holds memoryLimit bytes' worth of pairs;
+# when that is less than 2k pairs, a full buffer is sorted and spilled to a run on disk, one file
+# per column. The threshold then becomes the largest weight with at least k spilled pairs at or
+# above it, found by binary search over the memory-mapped runs, and pairs below it are dropped on
+# arrival. iterPairs streams the top-k back in ascending order through a k-way merge that reads
+# the runs in blocks; past MAX_RUNS runs, they are merged into one.
+class SpillingTopKPairs(TopKPairs):
+    MEMORY_LIMIT = 1 << 28
+    MAX_RUNS = 64
+    # the three columns, their sorted copies and the sort order
+    PAIR_BYTES = 56
+
+    def __init__(self, k, memoryLimit = MEMORY_LIMIT, directory = None):
+        k = max(int(k), 0)
+        capacity = max(memoryLimit // SpillingTopKPairs.PAIR_BYTES, 2)
+        super().__init__(k, min(2 * k, capacity))
+        self.spilling = capacity < 2 * k
+        self.directory = directory
+        self.runDirectory = None
+        self.runs = []
+        self.noOfRuns = 0
+
+    def __len__(self):
+        return min(self.size + sum(len(run[1]) for run in self.runs), self.k)
+
+    def compact(self):
+        if not self.spilling:
+            return super().compact()
+        order = np.lexsort((self.targetIds[:self.size], self.sourceIds[:self.size], self.weights[:self.size]))
+        self.writeRun([(self.weights[order], self.sourceIds[order], self.targetIds[order])])
+        self.size = 0
+        if self.MAX_RUNS < len(self.runs):
+            runs, self.runs = self.runs, []
+            self.writeRun(self.merge(runs, len(self.weights) // 2))
+            self.removeRuns(runs)
+        self.setThreshold()
+
+    def iterPairs(self, chunkSize):
+        if not self.runs:
+            yield from super().iterPairs(chunkSize)
+            return
+        if self.size:
+            self.compact()
+        # ties on the threshold beyond k are the smallest pairs, the first ones the merge gives
+        surplus = max(self.countAtLeast(self.minimumWeight) - self.k, 0)
+        pending = []
+        for chunk in self.merge(self.runs, len(self.weights) // 2):
+            skipped = min(surplus, len(chunk[0]))
+            surplus -= skipped
+            pending.append(tuple(column[skipped:] for column in chunk))
+            if chunkSize <= sum(len(piece[0]) for piece in pending):
+                weights, sourceIds, targetIds = (np.concatenate([piece[column] for piece in pending]) for column in range(3))
+                end = len(weights) - len(weights) % chunkSize
+                for start in range(0, end, chunkSize):
+                    yield weights[start:start + chunkSize], sourceIds[start:start + chunkSize], targetIds[start:start + chunkSize]
+                pending = [(weights[end:], sourceIds[end:], targetIds[end:])]
+        if pending and sum(len(piece[0]) for piece in pending):
+            yield tuple(np.concatenate([piece[column] for piece in pending]) for column in range(3))
+
+    # writes a sorted run from chunks of (weights, source ids, target ids)
+    def writeRun(self, chunks):
+        if self.runDirectory is None:
+            self.runDirectory = tempfile.mkdtemp(prefix='topk.%d.' % os.getpid(), dir=self.directory)
+        path = os.path.join(self.runDirectory, str(self.noOfRuns))
+        self.noOfRuns += 1
+        size = 0
+        with open(path + '.weights', 'wb') as weights, open(path + '.sources', 'wb') as sources, open(path + '.targets', 'wb') as targets:
+            for chunk in chunks:
+                for column, f in zip(chunk, (weights, sources, targets)):
+                    np.ascontiguousarray(column).tofile(f)
+                size += len(chunk[0])
+        run = (path, np.empty(0), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        if size:
+            run = (path, np.memmap(path + '.weights', dtype=np.float64, mode='r', shape=(size,)),
+                   np.memmap(path + '.sources', dtype=np.int64, mode='r', shape=(size,)),
+                   np.memmap(path + '.targets', dtype=np.int64, mode='r', shape=(size,)))
+        self.runs.append(run)
+
+    def removeRuns(self, runs):
+        for path, weights, sourceIds, targetIds in runs:
+            for suffix in ('.weights', '.sources', '.targets'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def close(self):
+        runs, self.runs = self.runs, []
+        self.removeRuns(runs)
+        if self.runDirectory is not None:
+            shutil.rmtree(self.runDirectory, ignore_errors=True)
+            self.runDirectory = None
+
+    def countAtLeast(self, weight):
+        return sum(len(weights) - int(np.searchsorted(weights, weight, 'left')) for path, weights, sourceIds, targetIds in self.runs)
+
+    # float64 weights as int64 keys in the same order, so that the binary search runs over integers
+    def toKey(weight):
+        bits = int(np.array(weight, dtype=np.float64).view(np.int64))
+        return bits ^ 0x7fffffffffffffff if bits < 0 else bits
+
+    def fromKey(key):
+        return float(np.array(key ^ 0x7fffffffffffffff if key < 0 else key, dtype=np.int64).view(np.float64))
+
+    def setThreshold(self):
+        if self.countAtLeast(self.minimumWeight) < self.k:
+            return
+        runs = [weights for path, weights, sourceIds, targetIds in self.runs if len(weights)]
+        low = SpillingTopKPairs.toKey(max(self.minimumWeight, min(float(weights[0]) for weights in runs)))
+        high = SpillingTopKPairs.toKey(max(float(weights[-1]) for weights in runs))
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.k <= self.countAtLeast(SpillingTopKPairs.fromKey(middle)):
+                low = middle
+            else:
+                high = middle - 1
+        self.minimumWeight = SpillingTopKPairs.fromKey(low)
+
+    # Ascending merge of the pairs of sorted runs at or above the threshold, one key range at a time:
+    # the range runs up to the largest weight that leaves at most blockSize pairs below it over all
+    # the runs, and when the smallest weight alone has more, over the source ids within it. Each
+    # range is read from every run and sorted, so every pair is read and sorted once.
+    def merge(self, runs, blockSize):
+        positions = [int(np.searchsorted(weights, self.minimumWeight, 'left')) for path, weights, sourceIds, targetIds in runs]
+        while True:
+            remaining = [i for i, run in enumerate(runs) if positions[i] < len(run[1])]
+            if not remaining:
+                return
+            getWeightEnds = lambda key: [max(int(np.searchsorted(run[1], SpillingTopKPairs.fromKey(key), 'left')), position) for run, position in zip(runs, positions)]
+            low = min(SpillingTopKPairs.toKey(runs[i][1][positions[i]]) for i in remaining)
+            bound = SpillingTopKPairs.getBound(getWeightEnds, positions, low, max(SpillingTopKPairs.toKey(runs[i][1][-1]) for i in remaining) + 1, blockSize)
+            ends = getWeightEnds(bound)
+            if bound == low:
+                weight = SpillingTopKPairs.fromKey(low)
+                segmentEnds = [int(np.searchsorted(run[1], weight, 'right')) for run in runs]
+                getSourceEnds = lambda sourceId, side = 'left': [position + int(np.searchsorted(run[2][position:end], sourceId, side)) for run, position, end in zip(runs, positions, segmentEnds)]
+                segments = [i for i in remaining if positions[i] < segmentEnds[i]]
+                low = min(int(runs[i][2][positions[i]]) for i in segments)
+                bound = SpillingTopKPairs.getBound(getSourceEnds, positions, low, max(int(runs[i][2][segmentEnds[i] - 1]) for i in segments) + 1, blockSize)
+                ends = getSourceEnds(bound) if low < bound else getSourceEnds(low, 'right')
+            pieces = [SpillingTopKPairs.readRun(run[0], position, end) for run, position, end in zip(runs, positions, ends) if position < end]
+            weights, sourceIds, targetIds = (np.concatenate([piece[column] for piece in pieces]) for column in range(3))
+            order = np.lexsort((targetIds, sourceIds, weights))
+            yield weights[order], sourceIds[order], targetIds[order]
+            positions = ends
+
+    # largest integer bound in [low, high] for which the ends getEnds gives leave at most blockSize
+    # pairs after positions
+    def getBound(getEnds, positions, low, high, blockSize):
+        while low < high:
+            middle = (low + high + 1) // 2
+            if sum(end - position for end, position in zip(getEnds(middle), positions)) <= blockSize:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    # pairs [start, end) of a run, read rather than mapped, so they do not stay resident
+    def readRun(path, start, end):
+        return tuple(np.fromfile(path + suffix, dtype=dtype, count=end - start, offset=start * 8)
+                     for suffix, dtype in (('.weights', np.float64), ('.sources', np.int64), ('.targets', np.int64)))